@@ -0,0 +1,77 @@
+"""Measures task progress commits per second with many task threads writing
+at once, with the engine create_engine makes and with SQLAlchemy's defaults
+
+    python -m kettle.bench [engine string] [threads] [commits per thread]
+"""
+from threading import Thread
+import os
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy.exc import OperationalError
+
+from kettle import db
+from kettle.rollout import Rollout
+from kettle.tasks import Task
+
+def default_engine(engine_string):
+    "The engine create_engine used to make, with no pool or pragmas"
+    connect_args = {}
+    if engine_string.startswith('sqlite'):
+        connect_args['check_same_thread'] = False
+    return sqlalchemy.create_engine(engine_string, connect_args=connect_args)
+
+def run(engine, num_threads, num_commits):
+    "Returns commits per second, and the number that failed"
+    db.drop_all(engine)
+    db.create_all(engine)
+    rollout_id = engine.execute(Rollout.__table__.insert(), config={}).inserted_primary_key[0]
+    engine.execute(Task.__table__.insert(), [
+        {'id': i + 1, 'type': 'Task', 'rollout_id': rollout_id, 'state': {}}
+        for i in range(num_threads)])
+    update = Task.__table__.update().where(
+            Task.__table__.c.id == sqlalchemy.bindparam('task_id'))
+    failures = [0]
+    def work(task_id):
+        for i in range(num_commits):
+            try:
+                with engine.begin() as con:
+                    con.execute(update, task_id=task_id, state={'progress': i})
+                    con.execute(Task.__table__.select().where(Task.__table__.c.rollout_id == rollout_id))
+            except OperationalError:
+                failures[0] += 1
+    threads = [Thread(target=work, args=(i + 1,)) for i in range(num_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return (num_threads * num_commits - failures[0]) / elapsed, failures[0]
+
+def main():
+    engine_string = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] else None
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    num_commits = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    path = None
+    if engine_string is None:
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        engine_string = 'sqlite:///%s' % (path,)
+    try:
+        for name, make_engine in ('default', default_engine), ('tuned', db.create_engine):
+            engine = make_engine(engine_string)
+            rate, failures = run(engine, num_threads, num_commits)
+            engine.dispose()
+            print '%-8s %4d threads: %7.1f commits/s, %d failed' % (
+                    name, num_threads, rate, failures)
+    finally:
+        if path is not None:
+            for suffix in '', '-wal', '-shm':
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,23 @@
-from tasks import ParallelExecTask, SequentialExecTask
+import math
+
+from tasks import HealthGatedDelayTask, ParallelExecTask, SequentialExecTask
+
+DEFAULT_STAGES = ('one', 'half', 'all')
+
+def stage_target(num, total):
+    """How many of total items should have been picked once a stage of num is
+    done. num is a count, 'N%', 'one', 'half' or 'all'"""
+    text_nums = {
+            'one': 1,
+            'half': total/2,
+            'all': total,
+            }
+    if num in text_nums:
+        num = text_nums[num]
+    elif isinstance(num, basestring) and num.endswith('%'):
+        # Round up, so small percentages of small fleets still pick one
+        num = int(math.ceil(total * float(num[:-1]) / 100))
+    return min(num, total)
 
 def num_to_pick(num, unprocessed, processed=None):
     if processed is None:
@@ -6,49 +25,62 @@ def num_to_pick(num, unprocessed, processed=None):
     else:
         len_processed = len(processed)
     len_total = len_processed + len(unprocessed)
-    text_nums = {
-            'one': 1,
-            'half': len_total/2,
-            'all': len_total,
-            }
-    if num in text_nums:
-        num = text_nums[num]
-    num_to_pick = max(0, num - len_processed)
+    num_to_pick = max(0, stage_target(num, len_total) - len_processed)
     return num_to_pick
 
 def make_picker(items):
-    items_unpicked = list(items)
-    items_picked = list()
+    items = list(items)
+    num_picked = [0]
     def picker(num):
-        num_picks = num_to_pick(num, items_unpicked, items_picked)
-        picks = items_unpicked[:num_picks]
-        items_picked.extend(picks)
-        del items_unpicked[:num_picks]
-        return picks
+        start = num_picked[0]
+        end = max(start, stage_target(num, len(items)))
+        num_picked[0] = end
+        return items[start:end]
     return picker
 
-def gradual_exec(rollout_id, task_cls, delay_gen, args_kwargs_list):
+def gradual_exec(rollout_id, task_cls, delay_gen, args_kwargs_list, **kwargs):
     return gradual_exec_generic(
-            rollout_id, task_cls, delay_gen, args_kwargs_list, SequentialExecTask)
+            rollout_id, task_cls, delay_gen, args_kwargs_list, SequentialExecTask,
+            **kwargs)
 
-def gradual_exec_parallel(rollout_id, task_cls, delay_gen, args_kwargs_list):
+def gradual_exec_parallel(rollout_id, task_cls, delay_gen, args_kwargs_list, **kwargs):
     return gradual_exec_generic(
-            rollout_id, task_cls, delay_gen, args_kwargs_list, ParallelExecTask)
+            rollout_id, task_cls, delay_gen, args_kwargs_list, ParallelExecTask,
+            **kwargs)
 
-def gradual_exec_generic(rollout_id, task_cls, delay_gen, args_kwargs_list, run_task_cls):
+def gradual_exec_generic(rollout_id, task_cls, delay_gen, args_kwargs_list,
+        run_task_cls, stages=DEFAULT_STAGES, max_parallel=None):
+    """Exec the tasks in stages, each taking a cumulative share of them as
+    stage_target does, e.g. (1, '1%', '5%', '25%', 'all'). A delay from
+    delay_gen goes between stages.
+
+    max_parallel caps the workers of ParallelExecTask stages: one number for
+    all stages, or a sequence with one per stage."""
+    if not isinstance(max_parallel, (list, tuple)):
+        max_parallel = [max_parallel] * len(stages)
+    if len(max_parallel) != len(stages):
+        raise ValueError('max_parallel needs one value per stage')
     picker = make_picker(args_kwargs_list)
-    def make_steps_fn(num):
-        tasks = [task_cls(*args, **kwargs)
-                for (args, kwargs) in picker(num)]
-        if len(tasks) <= 1:
-            return tasks
-        else:
-            return [run_task_cls(rollout_id, tasks)]
     steps = []
-    for num in 'one', 'half', 'all':
-        next_steps = make_steps_fn(num)
-        if next_steps:
-            steps.extend(next_steps)
-            if num != 'all':
-                steps.append(delay_gen.next())
-    return SequentialExecTask(rollout_id, filter(None, steps)) # Remove no-op steps
+    for num, stage_max_parallel in zip(stages, max_parallel):
+        picks = picker(num)
+        if not picks:
+            continue
+        if steps:
+            delay = delay_gen.next()
+            if delay is not None: # None is a no-op step
+                steps.append(delay)
+        tasks = [task_cls(*args, **kwargs) for (args, kwargs) in picks]
+        if len(tasks) == 1:
+            steps.append(tasks[0])
+        elif issubclass(run_task_cls, ParallelExecTask):
+            steps.append(run_task_cls(rollout_id, tasks, max_workers=stage_max_parallel))
+        else:
+            steps.append(run_task_cls(rollout_id, tasks))
+    return SequentialExecTask(rollout_id, steps)
+
+def health_gated_delays(rollout_id, check, minutes=0, seconds=0, **kwargs):
+    "A delay_gen of delays that end early once check is passing"
+    while True:
+        yield HealthGatedDelayTask(
+                rollout_id, check, minutes=minutes, seconds=seconds, **kwargs)
@@ -1,8 +1,11 @@
 import contextlib
 
 import sqlalchemy
+import sqlalchemy.event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from kettle import settings
 from kettle.db import session
@@ -10,12 +13,46 @@ from kettle.db import session
 def create_engine(engine_string=None, *args, **kwargs):
     if engine_string is None:
         engine_string = settings.ENGINE_STRING
-    if engine_string.startswith('sqlite'):
+    is_sqlite = engine_string.startswith('sqlite')
+    if is_sqlite:
         # Make SQLite thread safe
         connect_args = kwargs.get('connect_args', {})
         connect_args['check_same_thread'] = False
         kwargs['connect_args'] = connect_args
-    return sqlalchemy.create_engine(engine_string, *args, **kwargs)
+    # In memory SQLite databases only exist for one connection, so can't pool
+    if not (is_sqlite and make_url(engine_string).database in (None, '', ':memory:')):
+        if is_sqlite:
+            # SQLAlchemy doesn't pool SQLite files unless asked
+            kwargs.setdefault('poolclass', QueuePool)
+        kwargs.setdefault('pool_size', settings.DB_POOL_SIZE)
+        max_overflow = settings.DB_MAX_OVERFLOW
+        if max_overflow is None:
+            max_overflow = max(0, max_connections() - settings.DB_POOL_SIZE)
+        kwargs.setdefault('max_overflow', max_overflow)
+        kwargs.setdefault('pool_recycle', settings.DB_POOL_RECYCLE)
+    engine_ = sqlalchemy.create_engine(engine_string, *args, **kwargs)
+    if is_sqlite:
+        sqlalchemy.event.listen(engine_, 'connect', set_sqlite_pragmas)
+    return engine_
+
+def max_connections():
+    """Connections a process may hold at once: one per rollout a worker runs
+    and per task thread the pools share, plus DB_POOL_HEADROOM"""
+    return (settings.WORKER_MAX_ROLLOUTS + settings.PARALLEL_MAX_TOTAL_WORKERS +
+            settings.DB_POOL_HEADROOM)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    pragmas = [
+            ('journal_mode', settings.SQLITE_JOURNAL_MODE),
+            ('synchronous', settings.SQLITE_SYNCHRONOUS),
+            ]
+    if settings.SQLITE_BUSY_TIMEOUT is not None:
+        pragmas.append(('busy_timeout', int(settings.SQLITE_BUSY_TIMEOUT * 1000)))
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        if value is not None:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
 
 engine = create_engine()
 
@@ -26,6 +63,19 @@ def make_session(bind=None):
         bind = engine
     session.Session = scoped_session(sessionmaker(bind=bind))
 
+def release_connection():
+    """End the session's transaction, returning its connection to the pool,
+    unless it has changes to flush. Loaded objects aren't expired"""
+    session_ = session.Session()
+    if (session_.new or session_.deleted or
+            any(session_.is_modified(obj) for obj in session_.dirty)):
+        return
+    session_.expire_on_commit = False
+    try:
+        session_.commit()
+    finally:
+        session_.expire_on_commit = True
+
 def drop_all(engine_=None):
     metadata_task('drop_all', engine_)
 
@@ -34,6 +84,7 @@ def create_all(engine_=None):
 
 def metadata_task(fn_name, engine_):
     from kettle.rollout import Rollout
+    import kettle.tasks # Registers the task table
     if engine_ is None:
         engine_ = engine
     metadata_fn = getattr(Rollout.metadata, fn_name)
@@ -44,7 +95,7 @@ def truncate_all(engine_=None):
     from kettle.rollout import Rollout
     if engine_ is None:
         engine_ = engine
-    with contextlib.closing(engine.connect()) as con:
+    with contextlib.closing(engine_.connect()) as con:
         trans = con.begin()
         for table in reversed(Rollout.metadata.sorted_tables):
             try:
@@ -1,23 +1,274 @@
+from base64 import b64decode, b64encode
+import cPickle as pickle
+import zlib
+
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.mutable import Mutable
-from sqlalchemy.types import TypeDecorator, VARCHAR
-import json
+from sqlalchemy.types import TypeDecorator, Text
+
+from kettle import settings
+
+try:
+    import ujson as json_codec
+except ImportError:
+    import json as json_codec
+
+# Prefix of values stored zlib compressed then base64 encoded. JSON text
+# can't start with it
+COMPRESSED_PREFIX = 'z:'
+# Key of the placeholder that a large dict value is stored in, as a string
+# of its own JSON, so that loading the dict doesn't decode it. A value that
+# is itself a dict of just this key is always stored in a placeholder too,
+# so it can't be mistaken for one
+LAZY_KEY = '__json__'
+# MySQL's TEXT holds only 64KB
+JSON_TEXT = Text().with_variant(mysql.LONGTEXT(), 'mysql')
+
+def dumps(value):
+    return json_codec.dumps(value)
+
+def loads(value):
+    return json_codec.loads(value)
+
+def compress(encoded):
+    threshold = settings.JSON_COMPRESS_THRESHOLD
+    if threshold is not None and len(encoded) > threshold:
+        if isinstance(encoded, unicode):
+            encoded = encoded.encode('utf-8')
+        return COMPRESSED_PREFIX + b64encode(zlib.compress(encoded))
+    return encoded
+
+def decompress(value):
+    if value.startswith(COMPRESSED_PREFIX):
+        return zlib.decompress(b64decode(value[len(COMPRESSED_PREFIX):]))
+    return value
+
+
+class LazyJSON(object):
+    "A dict value that is kept as its JSON until it is first read"
+    __slots__ = ('encoded',)
+
+    def __init__(self, encoded):
+        self.encoded = encoded
 
-class JSONEncodedDict(TypeDecorator):
-    "Represents an immutable structure as a json-encoded string."
+    def load(self):
+        return loads(self.encoded)
 
-    impl = VARCHAR
+    def __repr__(self):
+        return '<LazyJSON: %d chars>' % (len(self.encoded),)
+
+def _is_placeholder(value):
+    return isinstance(value, dict) and len(value) == 1 and LAZY_KEY in value
+
+
+class JSONEncoded(TypeDecorator):
+    "Represents an immutable structure as JSON in a TEXT column"
+
+    impl = JSON_TEXT
 
     def process_bind_param(self, value, dialect):
         if value is not None:
-            value = json.dumps(value)
+            value = compress(dumps(value))
         return value
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            value = json.loads(value)
+            value = loads(decompress(value))
         return value
 
+
+class JSONOrPickle(JSONEncoded):
+    "JSON, which can also read values a PickleType column stored before"
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return value
+        if isinstance(value, buffer):
+            value = str(value)
+        try:
+            return super(JSONOrPickle, self).process_result_value(value, dialect)
+        except ValueError:
+            return pickle.loads(value)
+
+
+def encode_dict(value, lazy=True):
+    """Encode a dict as JSONEncodedDict stores it. A MutationDict's values are
+    only encoded if they changed since it last was"""
+    cache = getattr(value, '_encoded', None)
+    threshold = settings.JSON_LAZY_THRESHOLD
+    items = []
+    # Not value.iteritems, as a MutationDict's would decode LazyJSON values
+    for key, item in dict.iteritems(value):
+        encoded = cache.get(key) if cache is not None else None
+        if encoded is None:
+            if isinstance(item, LazyJSON):
+                # Unread since it was loaded, so still as it was stored
+                encoded = item.encoded
+            else:
+                encoded = dumps(item)
+            if cache is not None:
+                cache[key] = encoded
+        if (isinstance(item, LazyJSON) or _is_placeholder(item) or
+                (lazy and threshold is not None and len(encoded) > threshold)):
+            encoded = dumps({LAZY_KEY: encoded})
+        items.append('%s:%s' % (dumps(key), encoded))
+    return compress('{%s}' % (','.join(items),))
+
+
+class Encoded(object):
+    "A column value that was encoded ahead of being written"
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class JSONEncodedDict(JSONEncoded):
+    """Represents a dict as JSON. If lazy, values whose JSON is longer than
+    JSON_LAZY_THRESHOLD are stored as strings of that JSON, and only decoded
+    when they are read. Python 2's dict() and ** copy a dict subclass without
+    reading its values, so a dict that is copied that way shouldn't be lazy"""
+
+    def __init__(self, lazy=True, *args, **kwargs):
+        super(JSONEncodedDict, self).__init__(*args, **kwargs)
+        self.lazy = lazy
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        if isinstance(value, Encoded):
+            return value.value
+        return encode_dict(value, self.lazy)
+
+    def process_result_value(self, value, dialect):
+        value = super(JSONEncodedDict, self).process_result_value(value, dialect)
+        if value is not None:
+            for key, item in value.iteritems():
+                if _is_placeholder(item):
+                    item = LazyJSON(item[LAZY_KEY])
+                    value[key] = item if self.lazy else item.load()
+        return value
+
+
+def _track(value, root, key):
+    "Copy dicts and lists in value into containers that report changes to root"
+    if isinstance(value, dict):
+        return TrackedDict(value, root, key)
+    if isinstance(value, list):
+        return TrackedList(value, root, key)
+    return value
+
+def _untrack(value):
+    if isinstance(value, dict):
+        return dict((k, _untrack(v)) for k, v in dict.iteritems(value))
+    if isinstance(value, list):
+        return [_untrack(v) for v in value]
+    return value
+
+def _same(a, b):
+    "Whether a and b would be stored the same, so setting one over the other is a no-op"
+    for container in dict, list:
+        if isinstance(a, container) or isinstance(b, container):
+            return isinstance(a, container) and isinstance(b, container) and a == b
+    return type(a) is type(b) and a == b
+
+def _changes(method):
+    def tracked_method(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._root._key_changed(self._key)
+        return result
+    tracked_method.__name__ = method.__name__
+    return tracked_method
+
+
+class TrackedDict(dict):
+    "A dict nested in a MutationDict. Changes mark its top level key changed"
+    __slots__ = ('_root', '_key')
+
+    def __init__(self, value, root, key):
+        self._root = root
+        self._key = key
+        dict.__init__(self, ((k, _track(v, root, key)) for k, v in value.iteritems()))
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, _track(v, self._root, self._key))
+        self._root._key_changed(self._key)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            dict.__setitem__(self, k, _track(v, self._root, self._key))
+        self._root._key_changed(self._key)
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self[k] = default
+        return self[k]
+
+    __delitem__ = _changes(dict.__delitem__)
+    pop = _changes(dict.pop)
+    popitem = _changes(dict.popitem)
+    clear = _changes(dict.clear)
+
+    def __reduce__(self):
+        return (dict, (_untrack(self),))
+
+
+class TrackedList(list):
+    "A list nested in a MutationDict. Changes mark its top level key changed"
+    __slots__ = ('_root', '_key')
+
+    def __init__(self, value, root, key):
+        self._root = root
+        self._key = key
+        list.__init__(self, (_track(v, root, key) for v in value))
+
+    def __setitem__(self, i, v):
+        list.__setitem__(self, i, _track(v, self._root, self._key))
+        self._root._key_changed(self._key)
+
+    def __setslice__(self, i, j, values):
+        list.__setslice__(self, i, j, [_track(v, self._root, self._key) for v in values])
+        self._root._key_changed(self._key)
+
+    def append(self, v):
+        list.append(self, _track(v, self._root, self._key))
+        self._root._key_changed(self._key)
+
+    def insert(self, i, v):
+        list.insert(self, i, _track(v, self._root, self._key))
+        self._root._key_changed(self._key)
+
+    def extend(self, values):
+        list.extend(self, [_track(v, self._root, self._key) for v in values])
+        self._root._key_changed(self._key)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    __delitem__ = _changes(list.__delitem__)
+    __delslice__ = _changes(list.__delslice__)
+    __imul__ = _changes(list.__imul__)
+    pop = _changes(list.pop)
+    remove = _changes(list.remove)
+    reverse = _changes(list.reverse)
+    sort = _changes(list.sort)
+
+    def __reduce__(self):
+        return (list, (_untrack(self),))
+
+
 class MutationDict(Mutable, dict):
+    """Dict that tells SQLAlchemy when it changes, including changes to the
+    dicts and lists nested in it. Setting a key to the value it already has
+    isn't a change. Each value's encoding is kept until it changes, so
+    saving re-encodes only the values that changed"""
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self._encoded = {}
+        for key, value in dict(*args, **kwargs).iteritems():
+            dict.__setitem__(self, key, _track(value, self, key))
+
     @classmethod
     def coerce(cls, key, value):
         "Convert plain dictionaries to MutationDict."
@@ -31,16 +282,105 @@ class MutationDict(Mutable, dict):
         else:
             return value
 
+    def _key_changed(self, key):
+        self._encoded.pop(key, None)
+        self.changed()
+
     def __setitem__(self, key, value):
         "Detect dictionary set events and emit change events."
 
-        dict.__setitem__(self, key, value)
-        self.changed()
+        if key in self and _same(self[key], value):
+            return
+        dict.__setitem__(self, key, _track(value, self, key))
+        self._key_changed(key)
 
     def __delitem__(self, key):
         "Detect dictionary del events and emit change events."
 
         dict.__delitem__(self, key)
+        self._key_changed(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self._encoded.clear()
         self.changed()
 
+    # Reads decode LazyJSON values in place. That isn't a change
+    def _load(self, key, value):
+        if isinstance(value, LazyJSON):
+            self._encoded[key] = value.encoded
+            value = _track(value.load(), self, key)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def _load_all(self):
+        for key, value in dict.items(self):
+            self._load(key, value)
+
+    def __getitem__(self, key):
+        return self._load(key, dict.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        value = self._load(key, dict.pop(self, key, *default))
+        self._key_changed(key)
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._key_changed(key)
+        return key, self._load(key, value)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def iteritems(self):
+        self._load_all()
+        return dict.iteritems(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def itervalues(self):
+        self._load_all()
+        return dict.itervalues(self)
+
+    def copy(self):
+        "A plain copy, with nothing tracked"
+        self._load_all()
+        return _untrack(self)
+
+    def encoded(self):
+        "Snapshot of the dict as it would be stored now"
+        return Encoded(encode_dict(self))
+
+    def __eq__(self, other):
+        self._load_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._load_all()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        return (dict, (self.copy(),))
+
 MutationDict.associate_with(JSONEncodedDict)
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from threading import Condition, Thread, current_thread
+import atexit
+
+import logbook
+from sqlalchemy import and_, bindparam
+
+from kettle import settings
+from kettle.db import session
+
+class WriteBehind(object):
+    """Coalesces row updates from many threads and writes them from a
+    background thread, in one transaction every TASK_SAVE_INTERVAL seconds.
+
+    Updates to the same row are merged, so a row changed many times between
+    writes costs one UPDATE. Callers that need their update durable before
+    they carry on pass wait=True, which triggers a write straight away and
+    blocks until it has been committed (a group commit). If a write fails,
+    its rows are written one at a time, so one bad row can't hold up the
+    rest, and dropped after WRITE_MAX_ATTEMPTS failures."""
+    def __init__(self):
+        self._cond = Condition()
+        self._pending = OrderedDict()
+        self._increments = OrderedDict()
+        self._pending_gen = 1
+        self._written_gen = 0
+        self._errors = {}
+        # Failed writes of each row since it was last written
+        self._attempts = {}
+        self._urgent = False
+        self._thread = None
+
+    def update(self, table, row_id, values, wait=False):
+        with self._cond:
+            self._pending.setdefault((table, row_id), {}).update(values)
+            gen = self._pending_gen
+            self._start()
+        if wait:
+            self._wait_written(gen)
+
+    def increment(self, table, key, deltas, wait=False):
+        """Add deltas, a dict of column names to numbers, to the row of table
+        whose primary key is key, a tuple of (column name, value) pairs. The row
+        is created if it doesn't exist. Increments to the same row are summed
+        into one UPDATE"""
+        with self._cond:
+            add_deltas(self._increments.setdefault((table, key), {}), deltas)
+            gen = self._pending_gen
+            self._start()
+        if wait:
+            self._wait_written(gen)
+
+    def flush(self):
+        "Block until everything queued so far has been committed"
+        with self._cond:
+            if not self._pending and not self._increments:
+                return
+            gen = self._pending_gen
+            self._start()
+        self._wait_written(gen)
+
+    def _wait_written(self, gen):
+        with self._cond:
+            self._urgent = True
+            self._cond.notify_all()
+            while self._written_gen < gen:
+                self._cond.wait()
+            error = self._errors.get(gen)
+        if error is not None:
+            raise error
+
+    def stop(self, timeout=5):
+        "Stop the writer thread, once it has written everything queued so far"
+        with self._cond:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._cond.notify_all()
+        thread.join(timeout)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='WriteBehind')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Stopped, or replaced by a thread started after a stop
+                stopping = self._thread is not current_thread()
+                if not self._urgent and not stopping:
+                    self._cond.wait(settings.TASK_SAVE_INTERVAL)
+                    stopping = self._thread is not current_thread()
+                self._urgent = False
+                pending, self._pending = self._pending, OrderedDict()
+                increments, self._increments = self._increments, OrderedDict()
+                gen = self._pending_gen
+                self._pending_gen += 1
+            error = None
+            if pending or increments:
+                try:
+                    self._write(pending, increments)
+                except Exception:
+                    # Find the rows at fault, so they can't hold up the rest
+                    pending, increments, error = self._write_each(pending, increments)
+                else:
+                    pending, increments = {}, {}
+                    self._attempts.clear()
+            with self._cond:
+                if error is not None:
+                    # Requeue under anything newer that arrived meanwhile
+                    for key, values in pending.iteritems():
+                        values.update(self._pending.get(key, {}))
+                        self._pending[key] = values
+                    for key, deltas in increments.iteritems():
+                        add_deltas(deltas, self._increments.get(key, {}))
+                        self._increments[key] = deltas
+                    self._errors[gen] = error
+                self._errors.pop(gen - 100, None)
+                self._written_gen = gen
+                self._cond.notify_all()
+            if stopping:
+                return
+
+    def _write_each(self, pending, increments):
+        """Write rows one per transaction. Returns the rows that failed, less
+        any that have failed WRITE_MAX_ATTEMPTS times, which are dropped, and
+        the last error"""
+        failed_pending, failed_increments = OrderedDict(), OrderedDict()
+        error = None
+        rows = [(failed_pending, key, {key: values}, {})
+                for key, values in pending.iteritems()]
+        rows += [(failed_increments, key, {}, {key: deltas})
+                for key, deltas in increments.iteritems()]
+        for failed, key, row_pending, row_increments in rows:
+            try:
+                self._write(row_pending, row_increments)
+            except Exception, e:
+                error = e
+                attempts = self._attempts.get(key, 0) + 1
+                if attempts >= settings.WRITE_MAX_ATTEMPTS:
+                    logbook.exception('Failed to write %s row %s %d times: dropping it' % (
+                        key[0].name, key[1], attempts))
+                    self._attempts.pop(key, None)
+                else:
+                    logbook.exception('Failed to write %s row %s: retrying' % (
+                        key[0].name, key[1]))
+                    self._attempts[key] = attempts
+                    failed[key] = (row_pending or row_increments)[key]
+            else:
+                self._attempts.pop(key, None)
+        return failed_pending, failed_increments, error
+
+    def _write(self, pending, increments):
+        # One executemany per table and set of columns
+        groups = OrderedDict()
+        for (table, row_id), values in pending.iteritems():
+            key = (table, tuple(sorted(values)))
+            groups.setdefault(key, []).append(dict(values, _row_id=row_id))
+        try:
+            for (table, columns), params in groups.iteritems():
+                statement = table.update().where(table.c.id == bindparam('_row_id'))
+                session.Session.execute(statement, params)
+            for (table, key), deltas in increments.iteritems():
+                increment_row(table, key, deltas)
+            session.Session.commit()
+        except Exception:
+            session.Session.rollback()
+            raise
+
+
+def add_deltas(totals, deltas):
+    for column, delta in deltas.iteritems():
+        totals[column] = totals.get(column, 0) + delta
+
+def increment_row(table, key, deltas):
+    "Add deltas to a row in the current transaction, as WriteBehind.increment"
+    where = and_(*[table.c[column] == value for column, value in key])
+    values = dict((column, table.c[column] + delta) for column, delta in deltas.iteritems())
+    result = session.Session.execute(table.update().where(where).values(values))
+    if not result.rowcount:
+        session.Session.execute(table.insert().values(dict(key, **deltas)))
+
+
+writer = WriteBehind()
@@ -0,0 +1,62 @@
+from collections import defaultdict
+from Queue import Empty, Full, Queue
+from threading import Lock
+
+import settings
+
+class Subscription(object):
+    "A subscriber's queue of (event_type, data) pairs for one rollout"
+    def __init__(self, rollout_id, max_queued):
+        self.rollout_id = rollout_id
+        self.queue = Queue(max_queued)
+        self.overflowed = False
+
+    def get(self, timeout=None):
+        "Next (event_type, data) pair, or None if timeout passes first"
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class EventBus(object):
+    """In-process fan out of rollout events to subscribers
+
+    Publishing never blocks: a subscriber whose queue is full is dropped and
+    marked as overflowed, so it can tell its client to resync."""
+    def __init__(self, max_queued=None):
+        self.max_queued = max_queued
+        self._subscriptions = defaultdict(set)
+        self._lock = Lock()
+
+    def subscribe(self, rollout_id):
+        max_queued = self.max_queued or settings.EVENT_QUEUE_SIZE
+        subscription = Subscription(rollout_id, max_queued)
+        with self._lock:
+            self._subscriptions[rollout_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.rollout_id)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.rollout_id]
+
+    def publish(self, rollout_id, event_type, data):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(rollout_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait((event_type, data))
+            except Full:
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+
+
+bus = EventBus()
+
+def publish(rollout_id, event_type, **data):
+    bus.publish(rollout_id, event_type, data)
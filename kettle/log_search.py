@@ -0,0 +1,203 @@
+from collections import OrderedDict
+from os import path
+from Queue import Full, Queue
+from threading import Event, Lock, Thread, local
+import sqlite3
+import sys
+import traceback
+
+import settings
+
+# Matching lines returned for each log
+SEARCH_MAX_LINES = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    rollout_id INTEGER NOT NULL,
+    task_id INTEGER,
+    action TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS logs_rollout_id ON logs (rollout_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS lines USING fts4 (
+    line, log_id, notindexed=log_id
+);
+"""
+
+def index_filename():
+    if not settings.LOG_SEARCH_INDEX:
+        return None
+    return path.join(settings.LOG_DIR, settings.LOG_SEARCH_INDEX)
+
+def parse_log_name(name):
+    """(rollout_id, task_id, action) of a log named as log_filename names them,
+    or None if it isn't a rollout's or task's log"""
+    parts = name.split('.')
+    try:
+        if len(parts) == 2:
+            return int(parts[0]), None, parts[1]
+        if len(parts) == 3:
+            return int(parts[0]), int(parts[1]), parts[2]
+    except ValueError:
+        pass
+    return None
+
+
+class LogIndex(object):
+    """SQLite full text index of the lines in rollout and task logs
+
+    Each thread gets its own connection. Lines are queued for the indexer as
+    the log multiplexer writes them, so searches never read the log files
+    themselves."""
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=settings.SQLITE_BUSY_TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _log_id(self, conn, name):
+        row = conn.execute('SELECT id FROM logs WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            return row[0]
+        rollout_id, task_id, action = parse_log_name(name)
+        return conn.execute(
+                'INSERT INTO logs (name, rollout_id, task_id, action) VALUES (?, ?, ?, ?)',
+                (name, rollout_id, task_id, action)).lastrowid
+
+    def add(self, logs):
+        "Index logs, a dict of log file paths to the chunks just written to them"
+        conn = self._connect()
+        with conn:
+            for filename, chunks in logs.iteritems():
+                name = path.basename(filename)
+                if (path.dirname(filename) != path.normpath(settings.LOG_DIR) or
+                        parse_log_name(name) is None):
+                    continue
+                lines = ''.join(chunks).decode('utf-8', 'replace').splitlines()
+                lines = [line for line in lines if line.strip()]
+                if not lines:
+                    continue
+                log_id = self._log_id(conn, name)
+                conn.executemany('INSERT INTO lines (line, log_id) VALUES (?, ?)',
+                        ((line, log_id) for line in lines))
+
+    def last_rollout_ids(self, num):
+        conn = self._connect()
+        return [row[0] for row in conn.execute(
+            'SELECT DISTINCT rollout_id FROM logs ORDER BY rollout_id DESC LIMIT ?',
+            (num,))]
+
+    def search(self, query, rollout_ids=None, last=None, max_lines=SEARCH_MAX_LINES):
+        """Logs with lines matching query, an FTS MATCH expression, e.g.
+        'error', '"connection refused"' or 'timeout NOT retrying'
+
+        Searches the rollouts in rollout_ids, or the last rollouts that logged
+        anything, or all of them. Returns a list of dicts of each log's
+        rollout_id, task_id, action, name, count of matching lines and the
+        first max_lines of them, in rollout, task then action order."""
+        conn = self._connect()
+        if rollout_ids is None and last is not None:
+            rollout_ids = self.last_rollout_ids(last)
+        sql = ('SELECT logs.name, logs.rollout_id, logs.task_id, logs.action, lines.line '
+               'FROM lines JOIN logs ON logs.id = lines.log_id WHERE lines MATCH ?')
+        params = [query]
+        if rollout_ids is not None:
+            if not rollout_ids:
+                return []
+            sql += ' AND logs.rollout_id IN (%s)' % (', '.join('?' * len(rollout_ids)),)
+            params.extend(rollout_ids)
+        sql += ' ORDER BY logs.rollout_id DESC, logs.task_id, logs.action, lines.docid'
+        results = OrderedDict()
+        for name, rollout_id, task_id, action, line in conn.execute(sql, params):
+            result = results.get(name)
+            if result is None:
+                result = results[name] = dict(name=name, rollout_id=rollout_id,
+                        task_id=task_id, action=action, count=0, lines=[])
+            result['count'] += 1
+            if len(result['lines']) < max_lines:
+                result['lines'].append(line)
+        return results.values()
+
+
+_indexes = {}
+
+def get_index():
+    "The LogIndex at LOG_SEARCH_INDEX, or None if search is off"
+    filename = index_filename()
+    if filename is None:
+        return None
+    index = _indexes.get(filename)
+    if index is None:
+        index = _indexes.setdefault(filename, LogIndex(filename))
+    return index
+
+class LogIndexer(object):
+    """Adds lines to the log index from its own thread, so that a slow or
+    locked index never holds up the log multiplexer. Batches that arrive
+    while LOG_SEARCH_QUEUE_SIZE are already waiting are dropped from the
+    index, though not from the log files"""
+    def __init__(self):
+        self._queue = None
+        self._lock = Lock()
+        self._thread = None
+
+    def add(self, index, logs):
+        self._start()
+        try:
+            self._queue.put_nowait((index, logs))
+        except Full:
+            sys.stderr.write('Log index queue full: not indexing %d logs\n' % (len(logs),))
+
+    def flush(self):
+        "Block until the lines queued so far are indexed"
+        if self._thread is None:
+            return
+        indexed = Event()
+        self._queue.put((None, indexed))
+        indexed.wait()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._queue = Queue(settings.LOG_SEARCH_QUEUE_SIZE)
+                thread = Thread(target=self._run, name='LogIndexer')
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def _run(self):
+        while True:
+            index, logs = self._queue.get()
+            if index is None:
+                logs.set()
+                continue
+            try:
+                index.add(logs)
+            except Exception:
+                # Can't log this, as the error would be indexed back here
+                sys.stderr.write('Failed to index logs:\n%s' % (traceback.format_exc(),))
+
+indexer = LogIndexer()
+
+def search(query, rollout_ids=None, last=None, max_lines=SEARCH_MAX_LINES):
+    index = get_index()
+    if index is None:
+        raise Exception('Log search is off: set LOG_SEARCH_INDEX')
+    return index.search(query, rollout_ids, last, max_lines)
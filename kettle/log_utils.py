@@ -1,8 +1,24 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import closing
 from os import path
+from Queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import sleep
+import atexit
+import json
+import os
+import shutil
+import struct
+import sys
+import traceback
+import zipfile
+import zlib
 
-from logbook import NestedSetup
-from logbook.handlers import Handler
+from logbook import NOTSET, NestedSetup
+from logbook.handlers import Handler, StringFormatterHandlerMixin
 
+import log_search
 import settings
 
 def get_thread_handlers():
@@ -16,5 +32,374 @@ def get_thread_handlers():
 def inner_thread_nested_setup(outer_handlers):
     return NestedSetup([h for h in outer_handlers if h not in get_thread_handlers()])
 
+# Most log lines the multiplexer writes between flushes
+LOG_BATCH_SIZE = 1000
+# Seconds between flush's checks that the writer thread is still alive
+LOG_FLUSH_CHECK_INTERVAL = 1
+
+class LogMultiplexer(object):
+    """Writes log lines for any number of files from one background thread
+
+    Callers only queue lines, so logging never waits on disk. At most
+    LOG_MAX_OPEN_FILES files are kept open, closing the least recently
+    written. Lines are written in batches, with one write and flush per
+    file per batch, and each batch is added to the log search index."""
+    def __init__(self):
+        self._queue = Queue()
+        self._files = OrderedDict()
+        self._lock = Lock()
+        self._thread = None
+
+    def write(self, filename, data):
+        self._start()
+        self._queue.put((filename, data))
+
+    def close(self, filename):
+        "Close filename once the lines queued for it so far are written"
+        if self._thread is not None:
+            self._queue.put((filename, None))
+
+    def flush(self):
+        """Block until the lines queued so far are written, or the writer
+        thread has died"""
+        thread = self._thread
+        if thread is None:
+            return
+        written = Event()
+        self._queue.put((None, written))
+        while not written.wait(LOG_FLUSH_CHECK_INTERVAL):
+            if not thread.is_alive():
+                sys.stderr.write('Log writer thread died: lines not written\n')
+                return
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                thread = Thread(target=self._run, name='LogMultiplexer')
+                thread.daemon = True
+                thread.start()
+                atexit.register(self.flush)
+                self._thread = thread
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception:
+                # The thread must carry on, or every later line is lost
+                sys.stderr.write('Failed to write log batch:\n%s' % (
+                    traceback.format_exc(),))
+
+    def _write_batch(self, batch):
+        lines = OrderedDict()
+        closes = []
+        waiters = []
+        for filename, data in batch:
+            if filename is None:
+                waiters.append(data)
+            elif data is None:
+                closes.append(filename)
+            else:
+                lines.setdefault(filename, []).append(data)
+        try:
+            for filename, data in lines.iteritems():
+                try:
+                    f = self._open(filename)
+                    f.write(''.join(data))
+                    f.flush()
+                except Exception:
+                    # Can't log this, as the error could be logged back here
+                    sys.stderr.write('Failed to write log %s:\n%s' % (
+                        filename, traceback.format_exc()))
+            for filename in closes:
+                f = self._files.pop(filename, None)
+                try:
+                    if f is not None:
+                        f.close()
+                except Exception:
+                    sys.stderr.write('Failed to close log %s:\n%s' % (
+                        filename, traceback.format_exc()))
+            self._index(lines)
+        finally:
+            for waiter in waiters:
+                waiter.set()
+
+    def _index(self, lines):
+        index = log_search.get_index()
+        if index is not None and lines:
+            log_search.indexer.add(index, lines)
+
+    def _open(self, filename):
+        f = self._files.pop(filename, None)
+        if f is None:
+            while len(self._files) >= settings.LOG_MAX_OPEN_FILES:
+                self._files.popitem(last=False)[1].close()
+            f = open(filename, 'a')
+        self._files[filename] = f
+        return f
+
+multiplexer = LogMultiplexer()
+
+
+class MultiplexedFileHandler(Handler, StringFormatterHandlerMixin):
+    """Appends to a file like logbook's FileHandler, but through the log
+    multiplexer. Records are formatted in the logging thread"""
+    def __init__(self, filename, level=NOTSET, format_string=None,
+            filter=None, bubble=False, encoding='utf-8'):
+        Handler.__init__(self, level, filter, bubble)
+        StringFormatterHandlerMixin.__init__(self, format_string)
+        self.filename = filename
+        self.encoding = encoding
+        # Create the file now, as FileHandler does
+        multiplexer.write(filename, '')
+
+    def emit(self, record):
+        line = self.format(record) + '\n'
+        if isinstance(line, unicode):
+            line = line.encode(self.encoding, 'replace')
+        multiplexer.write(self.filename, line)
+
+
 def log_filename(*args):
     return path.join(settings.LOG_DIR, '.'.join(map(str, args)))
+
+def safe_log_filename(*args):
+    "log_filename, refusing any argument that could lead out of LOG_DIR"
+    for arg in map(str, args):
+        if not arg or arg.startswith('.') or os.sep in arg or (os.altsep and os.altsep in arg):
+            raise ValueError('Invalid log name component: %r' % (arg,))
+    return log_filename(*args)
+
+# Separates a log's name from the number of a later part of it in an archive
+ARCHIVE_PART_SEP = '~'
+# Uncompressed bytes in each separately compressed block of an archived log
+ARCHIVE_BLOCK_SIZE = 64 * 1024
+# Prefix of the archive member holding the block offsets of each log part.
+# Log names can't contain a slash, so these can't clash with them
+ARCHIVE_INDEX_PREFIX = 'index/'
+
+def archive_filename(rollout_id):
+    return log_filename(rollout_id, 'zip')
+
+def _compress_blocks(src, dst):
+    """Compress file src into file dst in ARCHIVE_BLOCK_SIZE blocks, each on
+    its own, so any one can be read without the rest. Returns their index"""
+    offsets = [0]
+    size = 0
+    with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+        while True:
+            block = f_in.read(ARCHIVE_BLOCK_SIZE)
+            if not block:
+                break
+            compressed = zlib.compress(block)
+            f_out.write(compressed)
+            offsets.append(offsets[-1] + len(compressed))
+            size += len(block)
+    return dict(block_size=ARCHIVE_BLOCK_SIZE, size=size, offsets=offsets)
+
+def archive_logs(rollout_id):
+    """Move a rollout's log files into a zip archive. Each is compressed in
+    blocks, stored as one member, with an index of the blocks' offsets in
+    another, so open_log can seek in it. Logs written since an earlier
+    archive are added to it as new parts, e.g. 1.rollout~2, so members
+    already archived are never rewritten"""
+    prefix = '%s.' % (rollout_id,)
+    archive_path = archive_filename(rollout_id)
+    multiplexer.flush()
+    # Not the archive, nor files left from archiving it
+    names = sorted(name for name in os.listdir(settings.LOG_DIR)
+            if name.startswith(prefix) and
+            not name.startswith(path.basename(archive_path)))
+    if not names:
+        return
+    for name in names:
+        multiplexer.close(path.join(settings.LOG_DIR, name))
+    multiplexer.flush()
+
+    # Appending overwrites the archive's directory, so append to a copy that
+    # replaces it once whole. The copy is of the compressed bytes, in chunks
+    tmp_path = archive_path + '.tmp'
+    blocks_path = archive_path + '.blocks'
+    mode = 'w'
+    if path.exists(archive_path):
+        shutil.copyfile(archive_path, tmp_path)
+        mode = 'a'
+    try:
+        with closing(zipfile.ZipFile(tmp_path, mode, zipfile.ZIP_DEFLATED,
+                allowZip64=True)) as archive:
+            members = set(archive.namelist())
+            for name in names:
+                member = name
+                part = 1
+                while member in members:
+                    part += 1
+                    member = '%s%s%d' % (name, ARCHIVE_PART_SEP, part)
+                index = _compress_blocks(path.join(settings.LOG_DIR, name), blocks_path)
+                # Already compressed, and stored as is so it can be seeked in
+                archive.write(blocks_path, member, zipfile.ZIP_STORED)
+                archive.writestr(ARCHIVE_INDEX_PREFIX + member, json.dumps(index))
+    finally:
+        if path.exists(blocks_path):
+            os.remove(blocks_path)
+    os.rename(tmp_path, archive_path)
+    for name in names:
+        os.remove(path.join(settings.LOG_DIR, name))
+
+
+class ArchivedLog(object):
+    """Read only file over the parts of a log in a rollout archive, as one.
+    Seeking is cheap, and only the blocks read are decompressed, one at a
+    time"""
+    def __init__(self, f, parts):
+        "f is the open archive, parts a list of (data offset, index) in order"
+        self._f = f
+        self._starts = []
+        self._parts = []
+        self.size = 0
+        for data_offset, index in parts:
+            self._starts.append(self.size)
+            self._parts.append((data_offset, index))
+            self.size += index['size']
+        self._pos = 0
+        self._block_key = None
+        self._block = ''
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0 and self._pos < self.size:
+            data = self._read_block()
+            if size > 0:
+                data = data[:size]
+                size -= len(data)
+            chunks.append(data)
+            self._pos += len(data)
+        return ''.join(chunks)
+
+    def _read_block(self):
+        "The rest of the block at the current position"
+        part = bisect_right(self._starts, self._pos) - 1
+        data_offset, index = self._parts[part]
+        pos = self._pos - self._starts[part]
+        block, skip = divmod(pos, index['block_size'])
+        if self._block_key != (part, block):
+            offsets = index['offsets']
+            self._f.seek(data_offset + offsets[block])
+            self._block = zlib.decompress(
+                    self._f.read(offsets[block + 1] - offsets[block]))
+            self._block_key = (part, block)
+        return self._block[skip:]
+
+    def close(self):
+        self._f.close()
+
+
+def _data_offset(f, info):
+    "Offset in the archive file f of the data of its member info"
+    f.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, f.read(zipfile.sizeFileHeader))
+    return (info.header_offset + zipfile.sizeFileHeader +
+            header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+def open_log(*args):
+    """Open the log named by args, as safe_log_filename, from its file or from
+    its rollout's archive. Returns the open file and its size, or None if
+    there is no such log"""
+    filename = safe_log_filename(*args)
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        pass
+    else:
+        return f, os.fstat(f.fileno()).st_size
+    name = path.basename(filename)
+    try:
+        f = open(archive_filename(args[0]), 'rb')
+    except IOError:
+        return None
+    try:
+        with closing(zipfile.ZipFile(f)) as archive:
+            parts = [(_data_offset(f, info),
+                      json.loads(archive.read(ARCHIVE_INDEX_PREFIX + info.filename)))
+                    for info in archive.infolist()
+                    if info.filename == name or
+                    info.filename.startswith(name + ARCHIVE_PART_SEP)]
+    except Exception:
+        f.close()
+        raise
+    if not parts:
+        f.close()
+        return None
+    log = ArchivedLog(f, parts)
+    return log, log.size
+
+LOG_CHUNK_SIZE = 64 * 1024
+
+def iter_file(f, start=0, length=None, chunk_size=LOG_CHUNK_SIZE):
+    "Yield the contents of f from start, length bytes or to EOF, in chunks"
+    f.seek(start)
+    while length is None or length > 0:
+        chunk = f.read(chunk_size if length is None else min(chunk_size, length))
+        if not chunk:
+            break
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+def tail_offset(f, num_lines, chunk_size=LOG_CHUNK_SIZE):
+    "Offset of the start of the last num_lines lines of f, reading backwards"
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    if num_lines <= 0:
+        return end
+    offset = end
+    newlines = 0
+    # A trailing newline ends the last line rather than starting a new one
+    if end:
+        f.seek(end - 1)
+        if f.read(1) == '\n':
+            newlines = -1
+    while offset > 0:
+        read_size = min(chunk_size, offset)
+        offset -= read_size
+        f.seek(offset)
+        chunk = f.read(read_size)
+        index = len(chunk)
+        while True:
+            index = chunk.rfind('\n', 0, index)
+            if index == -1:
+                break
+            newlines += 1
+            if newlines == num_lines:
+                return offset + index + 1
+    return 0
+
+def follow_file(f, start, is_live, poll_interval, chunk_size=LOG_CHUNK_SIZE):
+    """Yield the contents of f from start, then anything appended to it for as
+    long as is_live() returns True"""
+    offset = start
+    while True:
+        live = is_live()
+        for chunk in iter_file(f, offset, chunk_size=chunk_size):
+            offset += len(chunk)
+            yield chunk
+        if not live:
+            break
+        sleep(poll_interval)
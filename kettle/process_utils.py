@@ -0,0 +1,124 @@
+import atexit
+from multiprocessing import Manager, Pool
+from threading import Lock
+import os
+import signal
+
+import settings
+from utils import monotonic
+
+_lock = Lock()
+_pool = None
+_manager = None
+
+# Seconds between checks on an action running in the pool
+PROCESS_POLL_INTERVAL = 0.5
+
+def get_pool():
+    """The process pool and its manager, started on first use. They fork
+    from this process, so call this before starting threads where possible
+    (see PROCESS_POOL_EAGER): a fork copies locks held by other threads"""
+    global _pool, _manager
+    with _lock:
+        if _pool is None:
+            _manager = Manager()
+            _pool = Pool(settings.PROCESS_POOL_SIZE)
+            atexit.register(shutdown_pool)
+        return _pool, _manager
+
+def shutdown_pool():
+    global _pool, _manager
+    with _lock:
+        if _pool is not None:
+            _pool.terminate()
+            _manager.shutdown()
+            _pool = _manager = None
+
+
+class _ProxyListener(object):
+    "Sets an Event proxy in the manager process when a local event is set"
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def set(self):
+        self.proxy.set()
+
+
+def _call_action(task_cls, action, state, abort, term, started):
+    started['pid'] = os.getpid()
+    action_fn = getattr(task_cls, '_%s' % (action,))
+    action_return = action_fn(state, None, abort, term)
+    return action_return, state
+
+def run_in_process(task_cls, action, state, abort, term):
+    """Call task_cls's _run or _revert (as given by action) in the process pool,
+    passing no children. Returns what it returned, and updates state in
+    place with the action's changes to it. abort and term are bridged both
+    ways through events in a multiprocessing manager."""
+    pool, manager = get_pool()
+    bridges = []
+    for event in abort, term:
+        if event is None:
+            bridges.append((None, None, None))
+            continue
+        proxy = manager.Event()
+        listener = _ProxyListener(proxy)
+        if hasattr(event, 'add_listener'):
+            event.add_listener(listener)
+        elif event.is_set():
+            proxy.set()
+        bridges.append((event, proxy, listener))
+    try:
+        started = manager.dict()
+        result = pool.apply_async(_call_action, (
+            task_cls, action, state.copy(), bridges[0][1], bridges[1][1], started))
+        _wait_result(result, started, term, settings.PROCESS_TASK_TIMEOUT)
+        action_return, new_state = result.get()
+    finally:
+        for event, proxy, listener in bridges:
+            if event is None:
+                continue
+            if hasattr(event, 'remove_listener'):
+                event.remove_listener(listener)
+            # Pass on anything the action signalled, e.g. abort on failure
+            if proxy.is_set() and not event.is_set():
+                event.set()
+    for key in set(state) - set(new_state):
+        del state[key]
+    for key, value in new_state.iteritems():
+        if state.get(key) != value:
+            state[key] = value
+    return action_return
+
+def _wait_result(result, started, term, timeout):
+    """Wait for an action running in the pool. Raises if its process dies, and
+    kills its process and raises if term is set or it runs out of time"""
+    deadline = None if timeout is None else monotonic() + timeout
+    while not result.ready():
+        result.wait(PROCESS_POLL_INTERVAL)
+        if result.ready():
+            break
+        pid = started.get('pid')
+        if pid is not None and not _is_alive(pid):
+            raise Exception('Process %d running the task died' % (pid,))
+        if term is not None and term.is_set():
+            _kill(pid)
+            raise Exception('Terminated')
+        if deadline is not None and monotonic() > deadline:
+            _kill(pid)
+            raise Exception('Timed out after %s secs' % (timeout,))
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def _kill(pid):
+    "Kill a pool process. The pool starts another in its place"
+    if pid is not None:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
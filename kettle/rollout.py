@@ -1,14 +1,19 @@
-from collections import defaultdict
-from datetime import datetime
-from threading import Event, Thread
+from datetime import datetime, timedelta
+from threading import Thread
 
-from sqlalchemy import Column, DateTime, Integer, PickleType, Boolean, String, orm
-from logbook import FileHandler, NestedSetup, NullHandler
+from sqlalchemy import (
+        Column, DateTime, Index, Integer, Boolean, String, and_, case, or_, orm)
+import logbook
+from logbook import NestedSetup, NullHandler
 
+import events
+import settings
+import signals
 from db import Base, session
-from db.fields import JSONEncodedDict
-from log_utils import log_filename
-from tasks import thread_wait
+from db.fields import JSONEncodedDict, JSONOrPickle
+from db.writer import writer
+from log_utils import MultiplexedFileHandler, archive_logs, log_filename
+from thread_utils import thread_wait
 
 ROLLOUT_SIGNALS = ('abort_rollout', 'term_rollout', 'monitoring', 'skip_rollback')
 ROLLBACK_SIGNALS = ('abort_rollback', 'term_rollback')
@@ -28,12 +33,32 @@ SIGNAL_DESCRIPTIONS = {
                      'like kill -9.',
 }
 
+# Statuses that status_expression can tell from a rollout's columns alone
+DB_STATUSES = ('queued', 'not_started', 'started', 'finished', 'rolling_back',
+        'rollback_failed', 'rolled_back')
+
+def in_own_session(fn, *args):
+    "Call fn in a thread, removing the thread's session once it returns"
+    try:
+        return fn(*args)
+    finally:
+        session.Session.remove()
+
+
 class Rollout(Base):
     __tablename__ = 'rollout'
+    __table_args__ = (
+            Index('ix_rollout_hidden_id', 'hidden', 'id'),
+            Index('ix_rollout_user_id', 'user', 'id'),
+            Index('ix_rollout_rollout_start_dt', 'rollout_start_dt'),
+            Index('ix_rollout_rollout_finish_dt', 'rollout_finish_dt'),
+            )
     id = Column(Integer, primary_key=True)
     user = Column(String(255))
-    config = Column(JSONEncodedDict(1000))
-    stages = Column(PickleType)
+    # Not lazy, as forms are built from dict(config)
+    config = Column(JSONEncodedDict(lazy=False))
+    # Was a PickleType, so rows written before it was JSON are still read
+    stages = Column(JSONOrPickle)
 
     hidden = Column(Boolean, default=False)
 
@@ -44,9 +69,17 @@ class Rollout(Base):
 
     rollback_start_dt = Column(DateTime)
     rollback_finish_dt = Column(DateTime)
+    # Set if the rollback raised. It stays unfinished, so it can be resumed
+    rollback_error_dt = Column(DateTime)
+
+    # Set when waiting for a kettle-worker to run the rollout
+    queued_dt = Column(DateTime)
+    # The worker that claimed the rollout, and when its claim lapses unless
+    # renewed. An expired lease on an unfinished rollout means a lost worker
+    worker_id = Column(String(255))
+    lease_expires_dt = Column(DateTime)
 
     monitors = {}
-    signals = defaultdict(dict)
 
     def __init__(self, config):
         self.config = config
@@ -70,35 +103,135 @@ class Rollout(Base):
 
         self.rollout_start_dt = datetime.now()
         self.save()
+        try:
+            self._exec_rollout()
+        finally:
+            self.archive_logs()
+
+    def _exec_rollout(self):
         self._setup_signals_rollout()
+        self.publish_status()
 
         self.start_monitoring()
+        should_rollback = False
         try:
             with self.log_setup_rollout():
                 abort_rollout = self.signal('abort_rollout')
                 task_thread = self.root_task.run_threaded(abort_rollout)
-                thread_wait(task_thread, abort_rollout)
+                thread_wait(task_thread, abort_rollout, self.signal('term_rollout'))
             failed = self.is_aborting('rollout') or self.is_terming('rollout')
             skipping = self.is_skipping('rollback')
             should_rollback = failed and not skipping
         finally:
             self.stop_monitoring()
-            self._update_rollout_finish_dt()
+            self._finish_rollout(should_rollback)
             self._teardown_signals_rollout()
+            self.publish_status()
         if should_rollback:
             self.rollback()
 
+    def _finish_rollout(self, start_rollback):
+        """Record the rollout as finished and, if start_rollback, the rollback
+        as started, in one save. A crash before the rollback runs then leaves
+        it unfinished, for orphaned_query to find"""
+        if start_rollback:
+            self.rollback_start_dt = datetime.now()
+        if not self.rollout_finish_dt:
+            self.rollout_finish_dt = datetime.now()
+        self.save()
+
     def rollback(self):
         self.rollback_start_dt = datetime.now()
         self.save()
+        self._exec_rollback()
+
+    def _exec_rollback(self):
         self._setup_signals_rollback()
+        self.publish_status()
 
-        with self.log_setup_rollback():
-            self.root_task.revert()
+        try:
+            with self.log_setup_rollback():
+                self.root_task.revert()
+        except Exception:
+            self.rollback_error_dt = datetime.now()
+            raise
+        else:
+            self.rollback_finish_dt = datetime.now()
+        finally:
+            self.save()
+            self._teardown_signals_rollback()
+            self.publish_status()
 
-        self.rollback_finish_dt = datetime.now()
-        self.save()
-        self._teardown_signals_rollback()
+    @classmethod
+    def orphaned_query(cls):
+        "Rollouts or rollbacks that were started but never finished"
+        return session.Session.query(cls).filter(or_(
+            and_(cls.rollout_start_dt != None, cls.rollout_finish_dt == None),
+            and_(cls.rollback_start_dt != None, cls.rollback_finish_dt == None)))
+
+    @classmethod
+    def _resume(cls, id, policy=None):
+        """Carry on with a rollout whose process died part way through
+
+        Tasks that were interrupted are run again from their start, while
+        finished tasks and subtrees are skipped. An interrupted rollback is
+        resumed the same way. With the 'rollback' policy, or if a task had
+        already failed, the rollout is rolled back instead."""
+        from kettle.tasks import Task
+        if policy is None:
+            policy = settings.RESUME_POLICY
+        if policy not in ('resume', 'rollback'):
+            raise Exception('Unknown resume policy: %s' % (policy,))
+        self = cls._from_id(id)
+        root_task = self.load_task_tree()
+        tasks = session.Session.query(Task).filter(Task.rollout_id==self.id).all()
+
+        if self.rollback_start_dt:
+            if self.rollback_finish_dt:
+                raise Exception('Rollback already finished at %s' %
+                        (self.rollback_finish_dt,))
+        elif not self.rollout_start_dt or self.rollout_finish_dt:
+            raise Exception('Rollout is not in progress')
+
+        try:
+            if self.rollback_start_dt:
+                retry_failed = bool(self.rollback_error_dt)
+                self.rollback_error_dt = None
+                self._reset_interrupted(tasks, 'revert', retry_failed)
+                self._exec_rollback()
+                return
+            failed = any(task.run_error_dt for task in tasks)
+            if policy == 'rollback' or failed:
+                should_rollback = bool(root_task.run_start_dt)
+                self._finish_rollout(should_rollback)
+                if should_rollback:
+                    self.rollback()
+                else:
+                    self.publish_status()
+            else:
+                self._reset_interrupted(tasks, 'run')
+                self._exec_rollout()
+        finally:
+            self.archive_logs()
+
+    @staticmethod
+    def _reset_interrupted(tasks, action, retry_failed=False):
+        """Forget that tasks which never returned were started, so they run
+        again. With retry_failed, tasks whose action raised run again too"""
+        for task in tasks:
+            if (not getattr(task, '%s_start_dt' % (action,)) or
+                    getattr(task, '%s_return_dt' % (action,))):
+                continue
+            if getattr(task, '%s_error_dt' % (action,)):
+                if not retry_failed:
+                    continue
+                for field in ('error', 'error_dt', 'traceback'):
+                    setattr(task, '%s_%s' % (action, field), None)
+            setattr(task, '%s_start_dt' % (action,), None)
+        session.Session.commit()
+
+    def publish_status(self):
+        events.publish(self.id, 'rollout', status=self.status())
 
     @property
     def root_task(self):
@@ -114,14 +247,145 @@ class Rollout(Base):
         else:
             return root_task
 
+    def load_task_tree(self):
+        "Return the root task with the rest of the tree loaded in one query"
+        from kettle.tasks import Task, link_task_tree
+        tasks = session.Session.query(Task).filter(Task.rollout_id==self.id).all()
+        roots = link_task_tree(tasks)
+        if len(roots) > 1:
+            raise Exception('Could not get root task: more than one task has no '
+                    'parents: %s' % (roots,))
+        return roots[0] if roots else None
+
+    def tasks_changed_since(self, since=None):
+        """Tasks written to at or after since, plus any that are running since
+        their friendly_str can change without a write. All tasks if since is
+        None"""
+        from kettle.tasks import Task
+        query = session.Session.query(Task).filter(Task.rollout_id==self.id)
+        if since is not None:
+            query = query.filter(or_(
+                Task.updated_dt >= since,
+                and_(Task.run_start_dt != None, Task.run_return_dt == None,
+                    Task.run_error_dt == None),
+                and_(Task.revert_start_dt != None, Task.revert_return_dt == None,
+                    Task.revert_error_dt == None)))
+        return query.order_by(Task.id).all()
+
     def rollout_async(self):
         rollout_id = self.id
         # expunge stops error caused by having rollout in multiple sessions
         session.Session.expunge(self)
-        rollout_thread = Thread(target=self._rollout, args=(rollout_id,))
+        rollout_thread = Thread(target=in_own_session, args=(self._rollout, rollout_id))
         rollout_thread.start()
         return rollout_thread
 
+    @classmethod
+    def resume_orphaned_async(cls):
+        "Resume, each in a thread, rollouts left unfinished by a dead process"
+        ids = [id for (id,) in cls.orphaned_query().with_entities(cls.id)]
+        session.Session.commit()
+        threads = []
+        for id in ids:
+            thread = Thread(target=in_own_session, args=(cls._resume, id))
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def enqueue(self):
+        "Queue the rollout for a kettle-worker to run"
+        if self.rollout_start_dt or self.queued_dt:
+            raise Exception('Rollout already queued or started')
+        self.queued_dt = datetime.now()
+        self.save()
+
+    @classmethod
+    def claim_next(cls, worker_id, lease_secs):
+        """Claim the oldest queued rollout for worker_id. Returns its id, or
+        None if there was nothing to claim"""
+        candidate_ids = [id for (id,) in session.Session.query(cls.id).filter(
+            cls.queued_dt != None, cls.worker_id == None,
+            cls.rollout_start_dt == None).order_by(cls.queued_dt)[:10]]
+        for id in candidate_ids:
+            # Only one worker's update can match while worker_id is unset
+            claimed = session.Session.query(cls).filter(
+                    cls.id == id, cls.worker_id == None).update({
+                        'worker_id': worker_id,
+                        'lease_expires_dt': datetime.now() + timedelta(seconds=lease_secs),
+                        }, synchronize_session=False)
+            session.Session.commit()
+            if claimed:
+                return id
+        return None
+
+    @classmethod
+    def renew_leases(cls, worker_id, ids, lease_secs):
+        if not ids:
+            return
+        session.Session.query(cls).filter(
+                cls.id.in_(ids), cls.worker_id == worker_id).update({
+                    'lease_expires_dt': datetime.now() + timedelta(seconds=lease_secs),
+                    }, synchronize_session=False)
+        session.Session.commit()
+
+    @classmethod
+    def release_lease(cls, worker_id, id):
+        session.Session.query(cls).filter(
+                cls.id == id, cls.worker_id == worker_id).update(
+                        {'lease_expires_dt': None}, synchronize_session=False)
+        session.Session.commit()
+
+    @classmethod
+    def requeue_lost_claims(cls):
+        """Queue again rollouts whose worker stopped renewing its lease before
+        starting them, so another worker can claim them. Returns how many"""
+        requeued = session.Session.query(cls).filter(
+                cls.rollout_start_dt == None, cls.worker_id != None,
+                cls.lease_expires_dt < datetime.now()).update({
+                    'worker_id': None,
+                    'lease_expires_dt': None,
+                    }, synchronize_session=False)
+        session.Session.commit()
+        return requeued
+
+    @classmethod
+    def unqueue_unstarted(cls, worker_id, id):
+        """Take a rollout that worker_id failed to start off the queue, so it
+        doesn't show as queued for ever and can be run again"""
+        session.Session.query(cls).filter(
+                cls.id == id, cls.worker_id == worker_id,
+                cls.rollout_start_dt == None).update({
+                    'queued_dt': None,
+                    'worker_id': None,
+                    'lease_expires_dt': None,
+                    }, synchronize_session=False)
+        session.Session.commit()
+
+    @classmethod
+    def claim_lost(cls, worker_id, lease_secs):
+        "Take over the rollouts of lost workers. Returns the ids claimed"
+        claimed_ids = []
+        for (id,) in cls.lost_worker_query().with_entities(cls.id).all():
+            claimed = session.Session.query(cls).filter(
+                    cls.id == id, cls.lease_expires_dt < datetime.now()).update({
+                        'worker_id': worker_id,
+                        'lease_expires_dt': datetime.now() + timedelta(seconds=lease_secs),
+                        }, synchronize_session=False)
+            session.Session.commit()
+            if claimed:
+                claimed_ids.append(id)
+        return claimed_ids
+
+    @classmethod
+    def lost_worker_query(cls):
+        """Rollouts whose worker stopped renewing its lease after starting them
+        and before they finished"""
+        return session.Session.query(cls).filter(
+                cls.lease_expires_dt < datetime.now(),
+                cls.rollout_start_dt != None,
+                or_(cls.rollout_finish_dt == None,
+                    and_(cls.rollback_start_dt != None, cls.rollback_finish_dt == None)))
+
     def start_monitoring(self):
         monitoring = self.signal('monitoring')
         if monitoring.is_set():
@@ -143,6 +407,8 @@ class Rollout(Base):
         monitoring.clear()
 
     def save(self):
+        # Rollout saves mark phase boundaries: make task writes durable first
+        writer.flush()
         if self not in session.Session:
             session.Session.add(self)
         session.Session.commit()
@@ -150,10 +416,18 @@ class Rollout(Base):
     def generate_tasks(self):
         if self.rollout_start_dt:
             raise Exception('Cannot generate tasks after rollout has started')
-        # Clear any previous tasks
-        map(session.Session.delete, self.tasks)
+        from kettle.tasks import Task, TaskTreeBuilder
+        # Clear any previous tasks. Unparent them first, since deleting rows
+        # that reference each other in one statement upsets some databases
+        tasks = session.Session.query(Task).filter(Task.rollout_id==self.id)
+        tasks.update({'parent_id': None}, synchronize_session=False)
+        tasks.delete(synchronize_session=False)
         session.Session.commit()
-        self._generate_tasks()
+        # Their ids may be reused, so don't leave stale instances around
+        for task in [obj for obj in session.Session if isinstance(obj, Task)]:
+            session.Session.expunge(task)
+        with TaskTreeBuilder():
+            self._generate_tasks()
         self.generate_tasks_dt = datetime.now()
 
     def _generate_tasks(self):
@@ -161,6 +435,8 @@ class Rollout(Base):
 
     def status(self):
         if not self.rollout_start_dt:
+            if self.queued_dt:
+                return 'queued'
             return 'not_started'
 
         if not self.rollback_start_dt:
@@ -178,20 +454,58 @@ class Rollout(Base):
             if self.is_aborting('rollback'):
                 return 'aborting_rollback'
             if not self.rollback_finish_dt:
+                if self.rollback_error_dt:
+                    return 'rollback_failed'
                 return 'rolling_back'
             else:
                 return 'rolled_back'
 
-    def friendly_status(self):
-        status = self.status()
+    @classmethod
+    def status_expression(cls):
+        """SQL for status, but without the aborting and terminating statuses,
+        which come from signals"""
+        return case([
+            (and_(cls.rollout_start_dt == None, cls.queued_dt != None), 'queued'),
+            (cls.rollout_start_dt == None, 'not_started'),
+            (and_(cls.rollback_start_dt == None, cls.rollout_finish_dt == None), 'started'),
+            (cls.rollback_start_dt == None, 'finished'),
+            (and_(cls.rollback_finish_dt == None, cls.rollback_error_dt != None), 'rollback_failed'),
+            (cls.rollback_finish_dt == None, 'rolling_back'),
+            ], else_='rolled_back')
+
+    @classmethod
+    def history_query(cls, before=None, user=None, statuses=None, since=None, until=None):
+        """Visible rollouts with their status_expression, newest first. Pages
+        by id: before is the id of the last rollout on the previous page.
+        since and until bound when rollouts started"""
+        status = cls.status_expression().label('status')
+        query = session.Session.query(cls, status).filter(cls.hidden == False)
+        if before is not None:
+            query = query.filter(cls.id < before)
+        if user:
+            query = query.filter(cls.user == user)
+        if statuses:
+            query = query.filter(status.in_(statuses))
+        if since is not None:
+            query = query.filter(cls.rollout_start_dt >= since)
+        if until is not None:
+            query = query.filter(cls.rollout_start_dt < until)
+        return query.order_by(cls.id.desc())
+
+    def friendly_status(self, status=None):
+        if status is None:
+            status = self.status()
         return {
+                'queued': 'Queued at %s' % self.queued_dt,
                 'started': 'Started at %s' % self.rollout_start_dt,
                 'rolling_back': 'Rolling back at %s' % self.rollback_start_dt,
                 }.get(status, status.title().replace('_', ' '))
 
-    def friendly_status_html(self):
+    def friendly_status_html(self, status=None):
+        if status is None:
+            status = self.status()
         return '<span id="rollout_{id}_status" class="status {status}">{friendly_status}</span>'.format(
-                id=self.id, status=self.status(), friendly_status=self.friendly_status())
+                id=self.id, status=status, friendly_status=self.friendly_status(status))
 
     def rollout_friendly_status(self):
         return self.exec_friendly_status('rollout')
@@ -221,18 +535,18 @@ class Rollout(Base):
     @classmethod
     def get_signal(cls, id, signal_name):
         cls._check_signal_name(signal_name)
-        return cls.signals[id].get(signal_name)
+        return signals.get_backend().get(id, signal_name)
 
     def signal(self, signal_name):
         return self.get_signal(self.id, signal_name)
 
     def _make_signal(self, signal_name):
         self._check_signal_name(signal_name)
-        self.signals[self.id][signal_name] = Event()
+        signals.get_backend().make(self.id, signal_name)
 
     def _del_signal(self, signal_name):
         self._check_signal_name(signal_name)
-        del self.signals[self.id][signal_name]
+        signals.get_backend().delete(self.id, signal_name)
 
     def abort(self, action):
         return self._do_signal(self.id, 'abort_%s' % action)
@@ -267,6 +581,7 @@ class Rollout(Base):
             return False
         signal = cls.get_signal(id, signal_name)
         signal.set()
+        events.publish(id, 'signal', name=signal_name)
         return True
 
     @classmethod
@@ -291,11 +606,6 @@ class Rollout(Base):
     def _teardown_signals_rollback(self):
         map(self._del_signal, ROLLBACK_SIGNALS)
 
-    def _update_rollout_finish_dt(self):
-        if not self.rollout_finish_dt:
-            self.rollout_finish_dt = datetime.now()
-            self.save()
-
     @property
     def info_list(self):
         "A list of HTML strings to be displayed in bullet points in the rollout view"
@@ -309,7 +619,16 @@ class Rollout(Base):
     def log_setup_rollback(self):
         return self.log_setup_generic('rollback')
 
+    def archive_logs(self):
+        "Move this rollout's finished logs into its archive"
+        if not settings.LOG_ARCHIVE:
+            return
+        try:
+            archive_logs(self.id)
+        except Exception:
+            logbook.exception('Failed to archive logs of rollout %s' % (self.id,))
+
     def log_setup_generic(self, action):
         return NestedSetup(
                 self.base_handlers + (
-                    FileHandler(log_filename(self.id, action), bubble=True),))
+                    MultiplexedFileHandler(log_filename(self.id, action), bubble=True),))
@@ -0,0 +1,31 @@
+def kettle_worker(settings_module='settings'):
+    from kettle import settings
+    settings.load_settings(settings_module)
+
+    from kettle.worker import run_worker
+    run_worker()
+
+def kettle_search(settings_module='settings'):
+    "Lists the rollout and task logs with lines matching an SQLite FTS query"
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [-r ROLLOUT_ID]... [-n LAST] QUERY')
+    parser.add_option('-r', '--rollout', dest='rollout_ids', type='int',
+            action='append', help='search this rollout (repeatable)')
+    parser.add_option('-n', '--last', type='int',
+            help='search the last LAST rollouts')
+    parser.add_option('-m', '--max-lines', type='int', default=5,
+            help='matching lines shown per log (default %default)')
+    parser.add_option('-s', '--settings', default=settings_module,
+            help='settings module (default %default)')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no query')
+
+    from kettle import settings
+    settings.load_settings(options.settings)
+
+    from kettle.log_search import search
+    for result in search(' '.join(args), options.rollout_ids, options.last, options.max_lines):
+        print '%(name)s: %(count)d lines' % result
+        for line in result['lines']:
+            print '    %s' % (line.encode('utf-8'),)
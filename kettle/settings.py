@@ -28,11 +28,47 @@ ROLLOUT_CLS = None
 
 ROLLOUT_FORM_CLS = 'kettleweb.forms:RolloutForm'
 
+# Where rollout signals live. Use kettle.signals:DBSignalBackend when the web
+# app runs in several processes, or apart from the process running rollouts.
+# kettle.signals:FileSignalBackend shares them between processes on one host
+SIGNAL_BACKEND = 'kettle.signals:LocalSignalBackend'
+
+# Directory of FileSignalBackend's signal files. None is kettle-signals in
+# the temp directory
+SIGNAL_DIR = None
+
 ENGINE_STRING = 'sqlite:////tmp/kettle.sqlite'
 #ENGINE_STRING = 'mysql://root@localhost/kettle'
 
+# Connection pool for the engine. Every rollout and task thread holds a
+# session. DB_MAX_OVERFLOW None allows for all of them: see
+# db.max_connections. Connections are reopened after DB_POOL_RECYCLE seconds,
+# before MySQL's wait_timeout drops them
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = None
+# Connections allowed for beyond rollout and task threads: web requests, the
+# write-behind writer, signal watchers and the first thread of each pool
+DB_POOL_HEADROOM = 20
+DB_POOL_RECYCLE = 3600
+
+# SQLite pragmas set on each connection. WAL lets readers carry on during a
+# write, and busy_timeout makes writers wait their turn rather than fail
+# with "database is locked". None leaves SQLite's default
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_BUSY_TIMEOUT = 30
+SQLITE_SYNCHRONOUS = 'NORMAL'
+
 SECRET_KEY = None
 
+# Rollout config, stages and task state are stored as JSON in TEXT columns.
+# Stored JSON longer than this many characters is zlib compressed. None
+# never compresses
+JSON_COMPRESS_THRESHOLD = 4096
+
+# Task state and rollout config values whose JSON is longer than this are
+# only decoded when read, so loading a task doesn't decode large payloads
+JSON_LAZY_THRESHOLD = 1024
+
 APP_HOST = '0.0.0.0'
 
 APP_PORT = 5000
@@ -40,3 +76,84 @@ APP_PORT = 5000
 FLASK_DEBUG = False
 
 LOG_DIR = '/var/log/kettle'
+
+# Log files the log writer thread keeps open at once
+LOG_MAX_OPEN_FILES = 64
+
+# Move a rollout's logs into one zip file, LOG_DIR/<rollout id>.zip, once it
+# has finished. The web app reads them from there
+LOG_ARCHIVE = True
+
+# SQLite full text index of rollout and task log lines, relative to LOG_DIR.
+# None turns log search off
+LOG_SEARCH_INDEX = 'search.sqlite'
+
+# Batches of log lines waiting to be indexed before more are left unindexed
+LOG_SEARCH_QUEUE_SIZE = 1000
+
+# Upper limit on the worker threads any one ParallelExecTask will start,
+# whatever max_workers it was created with
+PARALLEL_MAX_WORKERS = 50
+
+# Upper limit on the worker threads beyond each pool's first that all
+# ParallelExecTasks in a process start between them
+PARALLEL_MAX_TOTAL_WORKERS = 50
+
+# Seconds to keep waiting for a running task once abort or term is set.
+# None waits for the task to finish however long it takes
+ABORT_GRACE_TIMEOUT = None
+
+# Keep reverting the other children of an exec task when one fails to
+# revert, rather than aborting the rollback. Exec tasks can override this
+# with their continue_on_error argument
+REVERT_CONTINUE_ON_ERROR = False
+
+# Events buffered per live progress subscriber before it is dropped
+EVENT_QUEUE_SIZE = 1000
+
+# Seconds subprocess_run gives a command to exit after SIGTERM before SIGKILL
+SUBPROCESS_KILL_TIMEOUT = 10
+
+# Seconds between batched writes of task progress. None commits every task
+# save straight away
+TASK_SAVE_INTERVAL = 0.5
+
+# Times the write-behind writer tries to write a row before dropping it
+WRITE_MAX_ATTEMPTS = 5
+
+# Seconds between DB and file signal backend checks for signals sent by other
+# processes
+SIGNAL_POLL_INTERVAL = 0.5
+
+# Queue rollouts for a kettle-worker process instead of running them in a
+# thread of the web app. Workers need SIGNAL_BACKEND to be the DB backend
+USE_ROLLOUT_WORKER = False
+
+# Rollouts one kettle-worker runs at once
+WORKER_MAX_ROLLOUTS = 4
+
+# Seconds between a worker's checks for queued rollouts and lease renewals
+WORKER_POLL_INTERVAL = 2
+
+# Seconds a worker's claim on a rollout lasts without being renewed
+WORKER_LEASE_SECS = 30
+
+# What to do with rollouts left unfinished by a process that died: 'resume'
+# carries on from the interrupted tasks, 'rollback' rolls them back and None
+# leaves them alone. Workers pick up rollouts whose lease has expired, and
+# the web app, when not using workers, those unfinished when it starts.
+# Resuming runs interrupted tasks again, so only turn it on if they are safe
+# to repeat
+RESUME_POLICY = None
+
+# Processes in the pool for tasks with run_in_process set. None means one
+# per CPU
+PROCESS_POOL_SIZE = None
+
+# Start the process pool when kettleweb or kettle-worker starts, before any
+# threads, rather than on first use
+PROCESS_POOL_EAGER = False
+
+# Seconds a task action may run in the process pool before it is killed.
+# None waits for as long as it takes
+PROCESS_TASK_TIMEOUT = None
@@ -0,0 +1,284 @@
+from collections import defaultdict
+from os import path
+from Queue import Empty, Queue
+from threading import Event, Lock, Thread
+import atexit
+import os
+import tempfile
+
+import logbook
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, UniqueConstraint
+
+import settings
+from db import Base, session
+from thread_utils import NotifyingEvent
+
+class LocalSignalBackend(object):
+    """Signals held as events in this process. Only requests served by the
+    process running a rollout can see its signals"""
+    def __init__(self):
+        self.signals = defaultdict(dict)
+
+    def make(self, rollout_id, signal_name):
+        self.signals[rollout_id][signal_name] = NotifyingEvent()
+
+    def delete(self, rollout_id, signal_name):
+        del self.signals[rollout_id][signal_name]
+        if not self.signals[rollout_id]:
+            del self.signals[rollout_id]
+
+    def get(self, rollout_id, signal_name):
+        return self.signals.get(rollout_id, {}).get(signal_name)
+
+
+class RolloutSignal(Base):
+    __tablename__ = 'rollout_signal'
+    id = Column(Integer, primary_key=True)
+    rollout_id = Column(Integer, ForeignKey('rollout.id'), nullable=False, index=True)
+    name = Column(String(50), nullable=False)
+    is_set = Column(Boolean, nullable=False, default=False)
+
+    __table_args__ = (UniqueConstraint('rollout_id', 'name'),)
+
+
+class RemoteSignal(object):
+    "A signal owned by a rollout running in another process"
+    def __init__(self, backend, rollout_id, signal_name, is_set):
+        self.backend = backend
+        self.rollout_id = rollout_id
+        self.signal_name = signal_name
+        self._is_set = is_set
+
+    def is_set(self):
+        return self._is_set
+
+    def set(self):
+        self.backend._mark_set([(self.rollout_id, self.signal_name)])
+        self._is_set = True
+
+
+class _SetRecorder(object):
+    "Listener that queues a local signal being set, to be written to the store"
+    def __init__(self, backend, rollout_id, signal_name):
+        self.backend = backend
+        self.key = (rollout_id, signal_name)
+
+    def set(self):
+        self.backend._set_queue.put(self.key)
+        self.backend._wake.set()
+
+
+class SyncedSignalBackend(LocalSignalBackend):
+    """Signals kept in a store that any process can send them through
+
+    The process running a rollout keeps local events for its tasks to wait on.
+    A single watcher thread writes local sets to the store, and polls the
+    store every SIGNAL_POLL_INTERVAL seconds for signals sent from elsewhere.
+    The watcher stops at exit, once it has written the sets so far.
+
+    Subclasses implement the store: _create, _remove, _lookup, _mark_set and
+    _find_set."""
+    def __init__(self):
+        super(SyncedSignalBackend, self).__init__()
+        self._lock = Lock()
+        self._set_queue = Queue()
+        self._wake = Event()
+        self._stopping = Event()
+        self._watcher = None
+
+    def make(self, rollout_id, signal_name):
+        self._create(rollout_id, signal_name)
+        with self._lock:
+            super(SyncedSignalBackend, self).make(rollout_id, signal_name)
+            event = self.signals[rollout_id][signal_name]
+            if self._watcher is None:
+                self._stopping.clear()
+                self._watcher = Thread(target=self._watch, name=type(self).__name__)
+                self._watcher.daemon = True
+                self._watcher.start()
+                atexit.register(self.stop)
+        event.add_listener(_SetRecorder(self, rollout_id, signal_name))
+
+    def delete(self, rollout_id, signal_name):
+        with self._lock:
+            super(SyncedSignalBackend, self).delete(rollout_id, signal_name)
+        self._remove(rollout_id, signal_name)
+
+    def get(self, rollout_id, signal_name):
+        local = super(SyncedSignalBackend, self).get(rollout_id, signal_name)
+        if local is not None:
+            return local
+        is_set = self._lookup(rollout_id, signal_name)
+        if is_set is None:
+            return None
+        return RemoteSignal(self, rollout_id, signal_name, is_set)
+
+    def stop(self, timeout=5):
+        "Stop the watcher thread, once it has written the local sets so far"
+        with self._lock:
+            watcher, self._watcher = self._watcher, None
+        if watcher is None:
+            return
+        self._stopping.set()
+        self._wake.set()
+        watcher.join(timeout)
+
+    def _watch(self):
+        while True:
+            self._wake.wait(settings.SIGNAL_POLL_INTERVAL)
+            self._wake.clear()
+            stopping = self._stopping.is_set()
+            try:
+                self._write_local_sets()
+                if not stopping:
+                    self._read_remote_sets()
+            except Exception:
+                logbook.exception('Failed to sync signals')
+                self._sync_failed()
+            if stopping:
+                self._watcher_stopped()
+                return
+
+    def _write_local_sets(self):
+        keys = set()
+        while True:
+            try:
+                keys.add(self._set_queue.get_nowait())
+            except Empty:
+                break
+        if keys:
+            self._mark_set(keys)
+
+    def _read_remote_sets(self):
+        with self._lock:
+            local_ids = list(self.signals)
+        if not local_ids:
+            return
+        for rollout_id, signal_name in self._find_set(local_ids):
+            event = LocalSignalBackend.get(self, rollout_id, signal_name)
+            if event is not None and not event.is_set():
+                event.set()
+
+    def _sync_failed(self):
+        pass
+
+    def _watcher_stopped(self):
+        pass
+
+
+class DBSignalBackend(SyncedSignalBackend):
+    "Signals stored in the rollout_signal table"
+    def _create(self, rollout_id, signal_name):
+        query = session.Session.query(RolloutSignal).filter_by(
+                rollout_id=rollout_id, name=signal_name)
+        query.delete(synchronize_session=False)
+        session.Session.add(RolloutSignal(
+            rollout_id=rollout_id, name=signal_name, is_set=False))
+        session.Session.commit()
+
+    def _remove(self, rollout_id, signal_name):
+        session.Session.query(RolloutSignal).filter_by(
+                rollout_id=rollout_id, name=signal_name).delete(
+                        synchronize_session=False)
+        session.Session.commit()
+
+    def _lookup(self, rollout_id, signal_name):
+        row = session.Session.query(RolloutSignal.is_set).filter_by(
+                rollout_id=rollout_id, name=signal_name).first()
+        if row is None:
+            return None
+        return row.is_set
+
+    def _mark_set(self, keys):
+        for rollout_id, signal_name in keys:
+            session.Session.query(RolloutSignal).filter_by(
+                    rollout_id=rollout_id, name=signal_name).update(
+                            {'is_set': True}, synchronize_session=False)
+        session.Session.commit()
+
+    def _find_set(self, rollout_ids):
+        rows = session.Session.query(RolloutSignal.rollout_id, RolloutSignal.name).filter(
+                RolloutSignal.rollout_id.in_(rollout_ids), RolloutSignal.is_set==True).all()
+        # End the transaction so the next poll sees new writes
+        session.Session.commit()
+        return rows
+
+    def _sync_failed(self):
+        session.Session.rollback()
+
+    def _watcher_stopped(self):
+        session.Session.remove()
+
+
+class FileSignalBackend(SyncedSignalBackend):
+    """Signals stored as files in SIGNAL_DIR, one per signal, holding 1 once
+    set. For processes on one machine without a shared database, e.g. tests"""
+    def _path(self, rollout_id, signal_name):
+        return path.join(self.signal_dir(), '%s.%s' % (rollout_id, signal_name))
+
+    @staticmethod
+    def signal_dir():
+        signal_dir = settings.SIGNAL_DIR
+        if signal_dir is None:
+            signal_dir = path.join(tempfile.gettempdir(), 'kettle-signals')
+        if not path.isdir(signal_dir):
+            try:
+                os.makedirs(signal_dir)
+            except OSError:
+                # Made by another process meanwhile
+                if not path.isdir(signal_dir):
+                    raise
+        return signal_dir
+
+    def _create(self, rollout_id, signal_name):
+        with open(self._path(rollout_id, signal_name), 'w') as f:
+            f.write('0')
+
+    def _remove(self, rollout_id, signal_name):
+        try:
+            os.remove(self._path(rollout_id, signal_name))
+        except OSError:
+            pass
+
+    def _lookup(self, rollout_id, signal_name):
+        try:
+            with open(self._path(rollout_id, signal_name)) as f:
+                return f.read() == '1'
+        except IOError:
+            return None
+
+    def _mark_set(self, keys):
+        for rollout_id, signal_name in keys:
+            try:
+                # Not 'w', which would recreate a deleted signal
+                with open(self._path(rollout_id, signal_name), 'r+') as f:
+                    f.write('1')
+            except IOError:
+                pass
+
+    def _find_set(self, rollout_ids):
+        rollout_ids = set(str(rollout_id) for rollout_id in rollout_ids)
+        keys = []
+        for name in os.listdir(self.signal_dir()):
+            rollout_id, _, signal_name = name.partition('.')
+            if rollout_id in rollout_ids and self._lookup(rollout_id, signal_name):
+                keys.append((int(rollout_id), signal_name))
+        return keys
+
+
+def check_worker_backend():
+    """Rollouts run by a kettle-worker can only be signalled from the web
+    app through a backend in the database"""
+    backend_cls = settings.get_cls(settings.SIGNAL_BACKEND)
+    if not issubclass(backend_cls, DBSignalBackend):
+        raise Exception('USE_ROLLOUT_WORKER needs SIGNAL_BACKEND to be '
+                'kettle.signals:DBSignalBackend, not %s' % (settings.SIGNAL_BACKEND,))
+
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = settings.get_cls(settings.SIGNAL_BACKEND)()
+    return _backend
@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Float, ForeignKey, Integer, String, func
+
+import settings
+from db import Base, session
+from db.writer import increment_row, writer
+
+# Task types listed as slowest on the dashboard
+DASHBOARD_SLOWEST_TYPES = 10
+
+class TaskSummary(Base):
+    """Counts and total durations of the finished task actions of each type
+    in a rollout, kept up to date as each action finishes"""
+    __tablename__ = 'task_summary'
+    rollout_id = Column(Integer, ForeignKey('rollout.id'), primary_key=True)
+    task_type = Column(String(50), primary_key=True)
+
+    run_ok = Column(Integer, nullable=False, default=0)
+    run_failed = Column(Integer, nullable=False, default=0)
+    run_secs = Column(Float, nullable=False, default=0)
+
+    revert_ok = Column(Integer, nullable=False, default=0)
+    revert_failed = Column(Integer, nullable=False, default=0)
+    revert_secs = Column(Float, nullable=False, default=0)
+
+
+def record_action(task, action, ok):
+    "Add a task's finished action to its rollout's summary"
+    if not type(task).summarised:
+        return
+    start_dt = getattr(task, '%s_start_dt' % (action,))
+    finish_dt = getattr(task, '%s_%s_dt' % (action, 'return' if ok else 'error'))
+    if start_dt is None or finish_dt is None:
+        return
+    key = (('rollout_id', task.rollout_id), ('task_type', type(task).__name__))
+    deltas = {
+        '%s_%s' % (action, 'ok' if ok else 'failed'): 1,
+        '%s_secs' % (action,): (finish_dt - start_dt).total_seconds(),
+        }
+    table = TaskSummary.__table__
+    if settings.TASK_SAVE_INTERVAL:
+        writer.increment(table, key, deltas)
+    else:
+        increment_row(table, key, deltas)
+        session.Session.commit()
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def dashboard(rollout_cls, days=30):
+    """Fleet wide figures for rollouts started in the last days: how many
+    finished and were rolled back, their median duration and the task types
+    that took longest to run on average. Reads only the window's rollouts
+    and their summary rows"""
+    from kettle.tasks import Task
+    since = datetime.now() - timedelta(days=days)
+    status = rollout_cls.status_expression()
+    counts = dict(session.Session.query(status, func.count(rollout_cls.id))
+            .filter(rollout_cls.rollout_start_dt >= since)
+            .group_by(status))
+    total = sum(counts.itervalues())
+    durations = [
+        (finish_dt - start_dt).total_seconds()
+        for start_dt, finish_dt in session.Session.query(
+            rollout_cls.rollout_start_dt, rollout_cls.rollout_finish_dt)
+        .filter(rollout_cls.rollout_start_dt >= since,
+            rollout_cls.rollout_finish_dt != None,
+            rollout_cls.rollback_start_dt == None)]
+
+    # Skips rows recorded for exec tasks before they were left out
+    unsummarised = [identity for identity, mapper in Task.__mapper__.polymorphic_map.items()
+            if not mapper.class_.summarised]
+    runs = func.sum(TaskSummary.run_ok + TaskSummary.run_failed)
+    mean_secs = (func.sum(TaskSummary.run_secs) / runs).label('mean_secs')
+    slowest = (session.Session.query(
+            TaskSummary.task_type, runs.label('runs'),
+            func.sum(TaskSummary.run_failed).label('failed'), mean_secs)
+        .join(rollout_cls, rollout_cls.id == TaskSummary.rollout_id)
+        .filter(rollout_cls.rollout_start_dt >= since,
+            ~TaskSummary.task_type.in_(unsummarised))
+        .group_by(TaskSummary.task_type)
+        .having(runs > 0)
+        .order_by(mean_secs.desc())
+        .limit(DASHBOARD_SLOWEST_TYPES)).all()
+
+    def rate(*statuses):
+        if not total:
+            return None
+        return float(sum(counts.get(s, 0) for s in statuses)) / total
+    return dict(
+            days=days,
+            total=total,
+            counts=counts,
+            success_rate=rate('finished'),
+            rollback_rate=rate('rolling_back', 'rollback_failed', 'rolled_back'),
+            median_secs=median(durations),
+            slowest=slowest)
@@ -1,18 +1,28 @@
+from collections import defaultdict, deque
 from datetime import datetime
-from time import sleep
+from select import select
 from subprocess import STDOUT, Popen, PIPE
+from threading import local
+import os
 import traceback
 
 import logbook
-from logbook import FileHandler, NestedSetup
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from logbook import NestedSetup
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, func
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship, backref
-
-from db import Base, session
-from db.fields import JSONEncodedDict
-from log_utils import log_filename, get_thread_handlers
-from thread_utils import make_exec_threaded, thread_wait
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+
+import events
+import settings
+from db import Base, release_connection, session
+from db.fields import JSONEncodedDict, MutationDict
+from db.writer import writer
+from log_utils import MultiplexedFileHandler, get_thread_handlers, log_filename
+import process_utils
+import summary
+from thread_utils import WorkerPool, make_exec_threaded, thread_wait, wait_any
+from utils import monotonic
 
 def action_fn(action):
     def do_action(instance):
@@ -27,11 +37,19 @@ def action_fn(action):
 
 class Task(Base):
     __tablename__ = 'task'
+
+    # Set on CPU bound task classes to call _run and _revert in a process
+    # pool. They get a copy of state, and None for children
+    run_in_process = False
+    # Whether the dashboard's task type figures count this class's actions.
+    # Off for tasks that only run children, which last as long as they do
+    summarised = True
+
     id = Column(Integer, primary_key=True)
     type = Column(String(50), nullable=False)
     rollout_id = Column(Integer, ForeignKey('rollout.id'), nullable=False)
     parent_id = Column(Integer, ForeignKey('task.id'))
-    state = Column(JSONEncodedDict(1000))
+    state = Column(JSONEncodedDict)
 
     run_start_dt = Column(DateTime)
     run_error = Column(String(500))
@@ -47,6 +65,11 @@ class Task(Base):
     revert_return_dt = Column(DateTime)
     revert_traceback = Column(String(1000))
 
+    # Bumped on every write so viewers can ask for what changed since a time
+    updated_dt = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (Index('ix_task_rollout_id_updated_dt', 'rollout_id', 'updated_dt'),)
+
     rollout = relationship('Rollout', backref=backref('tasks', order_by=id))
     children = relationship('Task', backref=backref('parent', remote_side='Task.id', order_by=id))
 
@@ -102,35 +125,86 @@ class Task(Base):
 
     def call_and_record_action(self, action):
         setattr(self, '%s_start_dt' % (action,), datetime.now())
-        self.save()
+        # Must be durable before the action starts, so rollback knows of it
+        self.save_behind(wait=True)
+        self.publish_event(action)
         # action_fn should be a classmethod, hence getattr explicitly on type
         action_fn = getattr(type(self), '_%s' % (action,))
         try:
             with self.log_setup_action(action):
                 abort, term = self.get_signals(action)
-                action_return = action_fn(self.state, self.children, abort, term)
+                if type(self).run_in_process:
+                    action_return = process_utils.run_in_process(
+                            type(self), action, self.state, abort, term)
+                else:
+                    action_return = action_fn(self.state, self.children, abort, term)
         except Exception, e:
-            setattr(self, '%s_error' % (action,), e.message)
-            setattr(self, '%s_traceback' % (action,), repr(traceback.format_exc()))
+            self.set_fitted('%s_error' % (action,), e.message)
+            self.set_fitted('%s_traceback' % (action,), repr(traceback.format_exc()))
             setattr(self, '%s_error_dt' % (action,), datetime.now())
+            summary.record_action(self, action, ok=False)
             raise
         else:
-            setattr(self, '%s_return' % (action,), action_return)
+            # Stored as a string column, so keep in memory as it'll be read back
+            if action_return is not None and not isinstance(action_return, basestring):
+                action_return = str(action_return)
+            self.set_fitted('%s_return' % (action,), action_return)
             setattr(self, '%s_return_dt' % (action,), datetime.now())
+            summary.record_action(self, action, ok=True)
         finally:
-            self.save()
+            self.save_behind()
+            self.publish_event(action)
+
+    def set_fitted(self, name, value):
+        "Set a string column, cut down to its length so strict MySQL accepts it"
+        length = self.__table__.c[name].type.length
+        if isinstance(value, basestring) and length and len(value) > length:
+            value = value[:length - 3] + '...'
+        setattr(self, name, value)
+
+    def publish_event(self, action):
+        events.publish(self.rollout_id, 'task', id=self.id, action=action,
+                status=self.status(),
+                error=bool(getattr(self, '%s_error_dt' % (action,))))
 
     def log_setup_action(self, action):
         return NestedSetup(
                 get_thread_handlers() +
-                (FileHandler(log_filename(
+                (MultiplexedFileHandler(log_filename(
                     self.rollout_id, self.id, action), bubble=True),))
 
     def save(self):
+        builder = TaskTreeBuilder.current()
+        if builder is not None and (self.id is None or isinstance(self.id, PendingId)):
+            builder.add(self)
+            return
         if self not in session.Session:
             session.Session.add(self)
         session.Session.commit()
 
+    def save_behind(self, wait=False):
+        """Queue this task's changed columns on the write-behind writer rather
+        than committing now. With wait, block until they are committed"""
+        if (not settings.TASK_SAVE_INTERVAL or self.id is None or
+                self not in session.Session or self in session.Session.new):
+            return self.save()
+        values = {}
+        for key in self.__table__.columns.keys():
+            if get_history(self, key).has_changes():
+                value = getattr(self, key)
+                if isinstance(value, MutationDict):
+                    # Snapshot, as the writer thread writes it later. Only
+                    # changed values are encoded again
+                    value = value.encoded()
+                elif isinstance(value, dict):
+                    value = dict(value)
+                values[key] = value
+                set_committed_value(self, key, getattr(self, key))
+        if values or wait:
+            writer.update(self.__table__, self.id, values, wait=wait)
+        # Don't hold a connection, and a stale snapshot, through the action
+        release_connection()
+
     def __repr__(self):
         return '<%s: id=%s, rollout_id=%s, state=%s>' % (
                 self.__class__.__name__, self.id, self.rollout_id, repr(self.state))
@@ -150,8 +224,20 @@ class Task(Base):
             log_link = '<a href="{url}">{action}</a>'.format(
                     url=log_url, action='%s log' % action.title())
             inner.append(log_link)
-        return '<span class="task {class_}">{inner}</span>'.format(
-                class_=self.status(), inner=' '.join(inner))
+        return '<span id="task_{id}" class="task {class_}">{inner}</span>'.format(
+                id=self.id, class_=self.status(), inner=' '.join(inner))
+
+    def status_dict(self):
+        return {
+                'id': self.id,
+                'parent_id': self.parent_id,
+                'status': self.status(),
+                'html': self.node_html(),
+                }
+
+    def node_html(self):
+        "HTML for this task alone, for patching into an already rendered tree"
+        return self.friendly_html()
 
     def status(self):
         if not self.run_start_dt:
@@ -169,15 +255,139 @@ class Task(Base):
                     return 'rolled_back'
 
 
+def link_task_tree(tasks):
+    """Fill in parent and children of every task from the list itself, so
+    walking the tree doesn't lazy load each level. Returns the root tasks"""
+    tasks_by_id = {task.id: task for task in tasks}
+    children = defaultdict(list)
+    for task in sorted(tasks, key=lambda t: t.id):
+        children[task.parent_id].append(task)
+    for task in tasks:
+        set_committed_value(task, 'children', children[task.id])
+        set_committed_value(task, 'parent', tasks_by_id.get(task.parent_id))
+    return children[None]
+
+
+class PendingId(object):
+    """The id of a task a TaskTreeBuilder has yet to insert. Using it in any
+    way raises, rather than passing on an id the task won't have"""
+    def _fail(self, *args):
+        raise Exception('Task ids are only allocated when the TaskTreeBuilder '
+                'block ends: link tasks as children rather than by id')
+
+    __int__ = __long__ = __index__ = __hash__ = __nonzero__ = _fail
+    __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = __cmp__ = _fail
+    __str__ = __unicode__ = _fail
+
+    def __repr__(self):
+        return '<id pending until the TaskTreeBuilder block ends>'
+
+
+class TaskTreeBuilder(object):
+    """While in its with block, new tasks are collected rather than saved.
+    On leaving it they get ids allocated up front and are inserted with a
+    single executemany, in one transaction that locks the task table against
+    other inserts.
+
+    The inserted tasks are not added to the session: query for them afterwards.
+    Tasks that were already saved can be made children, and are updated.
+    Until the block ends, a new task's id is a PendingId, which raises if
+    it is used."""
+    _local = local()
+
+    def __init__(self):
+        self.tasks = []
+        self.links = []
+        self._seen = set()
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'builder', None)
+
+    def __enter__(self):
+        if self.current() is not None:
+            raise Exception('Task tree builders cannot be nested')
+        self._local.builder = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._local.builder = None
+        if exc_type is None:
+            self.save()
+
+    def add(self, task, children=()):
+        for t in (task,) + tuple(children):
+            if id(t) not in self._seen:
+                self._seen.add(id(t))
+                self.tasks.append(t)
+                if t.id is None:
+                    t.id = PendingId()
+        if children:
+            self.links.append((task, list(children)))
+
+    def save(self):
+        new_tasks = [t for t in self.tasks if isinstance(t.id, PendingId)]
+        next_id = self._lock_next_id()
+        for offset, task in enumerate(new_tasks):
+            task.id = next_id + offset
+        for parent, children in self.links:
+            for child in children:
+                child.parent_id = parent.id
+            parent._children_saved(children)
+
+        now = datetime.now()
+        columns = Task.__table__.columns.keys()
+        rows = []
+        for task in new_tasks:
+            if task in session.Session:
+                session.Session.expunge(task)
+            row = {key: getattr(task, key) for key in columns}
+            row['type'] = type(task).__mapper__.polymorphic_identity
+            row['updated_dt'] = now
+            rows.append(row)
+        if rows:
+            session.Session.execute(Task.__table__.insert(), rows)
+        session.Session.commit()
+
+    @staticmethod
+    def _lock_next_id():
+        """The next free task id. Other inserts into the task table wait
+        until this transaction ends, so the ids after it stay free"""
+        if session.Session.get_bind().dialect.name == 'sqlite':
+            # SQLite has no FOR UPDATE: take its write lock with a no-op write
+            session.Session.execute(Task.__table__.delete().where(Task.id == None))
+        max_id = session.Session.query(func.max(Task.id)).with_for_update().scalar()
+        return (max_id or 0) + 1
+
+
+# Failed children named in an exec task's error, and the characters of each
+# one's error shown. All their ids are kept in state['failed_task_ids']
+FAILURES_SHOWN = 5
+FAILURE_CHARS = 60
+
 class ExecTask(Task):
     desc_string = ''
+    summarised = False
+
+    def _init(self, children, continue_on_error=None, *args, **kwargs):
+        if continue_on_error is not None:
+            self.state['continue_on_error'] = continue_on_error
+        builder = TaskTreeBuilder.current()
+        if builder is not None:
+            # Children get linked once the builder has allocated ids
+            builder.add(self, children)
+            return
 
-    def _init(self, children, *args, **kwargs):
         self.save()
 
         for child in children:
             child.parent = self
             child.save()
+        self._children_saved(children)
+
+    def _children_saved(self, children):
+        "Called once self and children have ids"
+        pass
 
     @classmethod
     def _run(cls, state, children, abort, term):
@@ -196,38 +406,79 @@ class ExecTask(Task):
                 (type(self).desc_string,
                 ''.join(['<li>%s</li>' % child.friendly_html() for child in self.children]))
 
+    def node_html(self):
+        # Exec tasks are rendered by their children, so have nothing to patch
+        return None
+
+
+    @staticmethod
+    def continue_on_error(state):
+        "Whether reverting carries on with the other children when one fails"
+        continue_on_error = state.get('continue_on_error')
+        if continue_on_error is None:
+            return settings.REVERT_CONTINUE_ON_ERROR
+        return continue_on_error
+
+    @staticmethod
+    def raise_failures(state, failures, num_tasks):
+        """Raise one exception for all of failures, a list of (task, exc_info),
+        and keep the ids of the failed tasks in state"""
+        state['failed_task_ids'] = [task.id for task, _ in failures]
+        if not failures:
+            return
+        if len(failures) == 1:
+            task, exc_info = failures[0]
+            raise Exception('Caught exception while executing task %s: %s' %
+                    (task, exc_info[1]))
+        shown = failures[:FAILURES_SHOWN]
+        message = '%d of %d tasks failed: %s' % (len(failures), num_tasks,
+            '; '.join('%s: %.*s' % (task.id, FAILURE_CHARS, exc_info[1])
+                for task, exc_info in shown))
+        if len(failures) > len(shown):
+            message += '; and %d more' % (len(failures) - len(shown),)
+        raise Exception(message)
+
 
 class SequentialExecTask(ExecTask):
-    def _init(self, children, *args, **kwargs):
-        super(SequentialExecTask, self)._init(children, *args, **kwargs)
+    def _children_saved(self, children):
         self.state['task_order'] = [child.id for child in children]
 
     @classmethod
     def exec_forwards(cls, state, tasks, abort, term):
-        cls.exec_tasks('run_threaded', state['task_order'], tasks, abort, term)
+        # Tasks that already finished are skipped when resuming a rollout
+        tasks = [t for t in tasks if not t.run_return_dt]
+        task_ids = set(t.id for t in tasks)
+        task_order = [t_id for t_id in state['task_order'] if t_id in task_ids]
+        cls.exec_tasks('run_threaded', task_order, tasks, abort, term, state)
 
     @classmethod
     def exec_backwards(cls, state, tasks, abort, term):
-        run_tasks = [t for t in tasks if t.run_start_dt]
+        run_tasks = [t for t in tasks if t.run_start_dt and not t.revert_return_dt]
         run_task_ids = set(t.id for t in run_tasks)
         task_order = [t_id for t_id in reversed(state['task_order']) if t_id in run_task_ids]
-        cls.exec_tasks('revert_threaded', task_order, run_tasks, abort, term)
+        cls.exec_tasks('revert_threaded', task_order, run_tasks, abort, term, state,
+                continue_on_error=cls.continue_on_error(state))
 
-    @staticmethod
-    def exec_tasks(method_name, task_order, tasks, abort, term):
+    @classmethod
+    def exec_tasks(cls, method_name, task_order, tasks, abort, term, state,
+            continue_on_error=False):
         task_ids = {task.id: task for task in tasks}
+        failures = []
         for task_id in task_order:
             if abort.is_set() or term.is_set():
                 break
             task = task_ids.pop(task_id)
-            thread = getattr(task, method_name)(abort)
-            thread_wait(thread, abort)
+            thread = getattr(task, method_name)(
+                    abort, term=term, abort_on_error=not continue_on_error)
+            thread_wait(thread, abort, term)
             if thread.exc_info is not None:
-                raise Exception('Caught exception while executing task %s: %s' %
-                        (task, thread.exc_info))
+                failures.append((task, thread.exc_info))
+                if not continue_on_error:
+                    break
         else:
             assert not task_ids, ("SequentialExecTask has children that are not "
                     "in its task_order: %s" % (task_ids,))
+        cls.raise_failures(state, failures, len(task_order))
 
     def friendly_html(self):
         task_order = self.state['task_order']
@@ -240,28 +491,50 @@ class SequentialExecTask(ExecTask):
 class ParallelExecTask(ExecTask):
     desc_string = 'Execute in parallel:'
 
+    def _init(self, children, max_workers=None, *args, **kwargs):
+        self.state['max_workers'] = max_workers
+        super(ParallelExecTask, self)._init(children, *args, **kwargs)
+
     @classmethod
     def exec_forwards(cls, state, tasks, abort, term):
-        cls.exec_tasks('run_threaded', tasks, abort, term)
+        # Tasks that already finished are skipped when resuming a rollout
+        cls.exec_tasks('run_threaded', [t for t in tasks if not t.run_return_dt],
+                abort, term, state)
 
     @classmethod
     def exec_backwards(cls, state, tasks, abort, term):
-        cls.exec_tasks('revert_threaded', [t for t in tasks if t.run_start_dt],
-                abort, term)
+        cls.exec_tasks('revert_threaded',
+                [t for t in tasks if t.run_start_dt and not t.revert_return_dt],
+                abort, term, state, continue_on_error=cls.continue_on_error(state))
 
     @staticmethod
-    def exec_tasks(method_name, tasks, abort, term):
-        threads = []
-        for task in tasks:
-            if abort.is_set() or term.is_set():
-                break
-            thread = getattr(task, method_name)(abort)
-            threads.append(thread)
-        for thread in threads:
-            thread_wait(thread, abort)
-            if thread.exc_info is not None:
-                raise Exception('Caught exception while executing task %s: %s' %
-                        (thread.target, thread.exc_info))
+    def pool_size(num_tasks, max_workers=None):
+        caps = [num_tasks, max_workers, settings.PARALLEL_MAX_WORKERS]
+        return max(1, min(c for c in caps if c))
+
+    @classmethod
+    def exec_tasks(cls, method_name, tasks, abort, term, state,
+            continue_on_error=False):
+        """Run method_name on tasks in a pool of at most max_workers threads.
+        Waits for every task, then raises one exception for all that failed"""
+        pool = WorkerPool(cls.pool_size(len(tasks), state.get('max_workers')),
+                name=cls.__name__)
+        try:
+            threads = []
+            for task in tasks:
+                if abort.is_set() or term.is_set():
+                    break
+                thread = getattr(task, method_name)(abort, pool=pool, term=term,
+                        abort_on_error=not continue_on_error)
+                threads.append((task, thread))
+            failures = []
+            for task, thread in threads:
+                thread_wait(thread, abort, term)
+                if thread.exc_info is not None:
+                    failures.append((task, thread.exc_info))
+        finally:
+            pool.shutdown(wait=False)
+        cls.raise_failures(state, failures, len(tasks))
 
 
 class DelayTask(Task):
@@ -273,27 +546,32 @@ class DelayTask(Task):
 
     @classmethod
     def _run(cls, state, children, abort, term):
-        cls.wait(cls.get_secs(state), abort=abort, term=term)
+        state['run_waited'] = cls.wait(cls.get_secs(state), abort=abort, term=term)
 
     @classmethod
     def _revert(cls, state, children, abort, term):
         if state['reversible']:
-            cls.wait(cls.get_secs(state), abort=abort, term=term)
+            state['revert_waited'] = cls.wait(
+                    cls.get_secs(state), abort=abort, term=term)
 
     @classmethod
     def wait(cls, secs, abort, term):
+        "Wait for secs or until abort or term is set. Returns seconds waited"
         logbook.info('Waiting for %s' % (cls.min_sec_str(secs),),)
-        for i in xrange(int(secs)):
-            if abort.is_set() or term.is_set():
-                break
-            sleep(1)
+        start = monotonic()
+        wait_any((abort, term), timeout=max(0, secs))
+        return monotonic() - start
 
     def friendly_str(self):
         delay_secs = self.get_secs(self.state)
         delay_str = self.min_sec_str(delay_secs)
+        waited = self.state.get('run_waited')
         if self.run_start_dt and not self.run_return_dt:
-            remaining_secs = delay_secs - (datetime.now() - self.run_start_dt).seconds
+            elapsed_secs = (datetime.now() - self.run_start_dt).total_seconds()
+            remaining_secs = max(0, delay_secs - elapsed_secs)
             remaining_str = ' (%s left)' % self.min_sec_str(remaining_secs)
+        elif waited is not None and waited < delay_secs:
+            remaining_str = ' (stopped after %s)' % self.min_sec_str(waited)
         else:
             remaining_str = ''
 
@@ -303,10 +581,12 @@ class DelayTask(Task):
 
     @staticmethod
     def min_sec_str(secs):
-        mins = secs / 60
+        mins = int(secs // 60)
         secs = secs % 60
         if mins:
             return '%d:%02d mins' % (mins, secs)
+        elif secs != int(secs):
+            return '%.1f secs' % (secs,)
         else:
             return '%d secs' % (secs,)
 
@@ -315,30 +595,222 @@ class DelayTask(Task):
         return (state.get('minutes', 0) * 60) + state.get('seconds', 0)
 
 
-def subprocess_run(command, abort, term, log=True, **kwargs):
-    if log:
-        logbook.info(command)
-    p = Popen(
-            args=command,
-            stdout=PIPE,
-            stderr=STDOUT,
-            **kwargs
-            )
-    outputs = []
-    for line in iter(p.stdout.readline, ''):
-        if term and term.is_set():
-            term = None # Don't spam calls to terminate
-            p.terminate()
-            logbook.info('Caught TERM signal: stopping')
+class HealthGatedDelayTask(DelayTask):
+    """Delay that ends early once a health check passes passes_needed times
+    in a row. Checks are registered by name in checks, and are called every
+    check_interval seconds with the task's state"""
+    checks = {}
+
+    def _init(self, check, minutes=0, seconds=0, reversible=False,
+            check_interval=10, passes_needed=3):
+        super(HealthGatedDelayTask, self)._init(minutes, seconds, reversible)
+        self.state.update(
+                check=check,
+                check_interval=check_interval,
+                passes_needed=passes_needed)
+
+    @classmethod
+    def _run(cls, state, children, abort, term):
+        check = cls.checks[state['check']]
+        secs = cls.get_secs(state)
+        logbook.info('Waiting for %s, or until %s passes %s times' % (
+            cls.min_sec_str(secs), state['check'], state['passes_needed']))
+        start = monotonic()
+        passes = 0
+        while True:
+            remaining = secs - (monotonic() - start)
+            if remaining <= 0:
+                break
+            if wait_any((abort, term), timeout=min(state['check_interval'], remaining)):
+                break
+            try:
+                healthy = check(state)
+            except Exception:
+                logbook.exception('Health check %s failed' % (state['check'],))
+                healthy = False
+            passes = passes + 1 if healthy else 0
+            if passes >= state['passes_needed']:
+                logbook.info('Health check %s passed: ending delay' % (state['check'],))
+                break
+        state['run_waited'] = monotonic() - start
+
+    def friendly_str(self):
+        return '%s, or until %s passes' % (
+                super(HealthGatedDelayTask, self).friendly_str(), self.state['check'])
+
+
+class ParallelCommandTask(Task):
+    """Run many commands at once from one thread, where a ParallelExecTask
+    would need a thread per command"""
+    def _init(self, commands, revert_commands=(), max_parallel=None, timeout=None):
+        self.state.update(
+                commands=list(commands),
+                revert_commands=list(revert_commands),
+                max_parallel=max_parallel,
+                timeout=timeout)
+
+    @classmethod
+    def _run(cls, state, children, abort, term):
+        cls.run_commands(state['commands'], state, abort, term)
+
+    @classmethod
+    def _revert(cls, state, children, abort, term):
+        cls.run_commands(state['revert_commands'], state, abort, term)
+
+    @classmethod
+    def run_commands(cls, commands, state, abort, term):
+        outputs = subprocess_run_many(commands, abort, term,
+                max_parallel=state['max_parallel'], timeout=state['timeout'])
+        failed = [c for c, o in zip(commands, outputs) if o is None]
+        if failed and not (term and term.is_set()):
+            raise Exception('%d of %d commands failed or were not run: %s' %
+                    (len(failed), len(commands), failed))
+
+    def friendly_str(self):
+        num = len(self.state['commands'])
+        max_parallel = self.state['max_parallel']
+        return 'Run %d command%s%s' % (num, '' if num == 1 else 's',
+                ' (%d at a time)' % (max_parallel,) if max_parallel else '')
+
+
+# Seconds subprocess_run waits for output before rechecking term and timeouts
+SUBPROCESS_POLL_INTERVAL = 0.5
+
+class _Command(object):
+    "A command run by subprocess_run_many, and its output so far"
+    def __init__(self, command, prefix, log, max_lines):
+        self.command = command
+        self.prefix = prefix
+        self.log = log
+        self.outputs = deque(maxlen=max_lines)
+        self.partial = ''
+        self.result = None
+
+    def start(self, timeout, kwargs):
+        if self.log:
+            logbook.info('%s%s' % (self.prefix, self.command))
+        self.p = Popen(
+                args=self.command,
+                stdout=PIPE,
+                stderr=STDOUT,
+                **kwargs
+                )
+        self.fd = self.p.stdout.fileno()
+        self.timeout = timeout
+        self.deadline = None if timeout is None else monotonic() + timeout
+        self.kill_at = None
+
+    def record(self, line):
         line = line.strip()
-        outputs.append(line)
-        if log:
-            logbook.info(line)
-    returncode = p.wait()
-    if returncode == 0:
-        return outputs
-    else:
-        if abort:
-            abort.set()
-        exc = Exception(command, outputs, returncode)
-        logbook.error(exc)
+        self.outputs.append(line)
+        if self.log:
+            logbook.info('%s%s' % (self.prefix, line))
+
+    def read(self):
+        "Read the output that is ready. Returns False at the end of output"
+        data = os.read(self.fd, 4096)
+        if not data:
+            return False
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        map(self.record, lines)
+        return True
+
+    def check_stop(self, now, term, kill_timeout):
+        """Send SIGTERM if term is set or the command has timed out, then
+        SIGKILL kill_timeout seconds later. Returns True once it has exited"""
+        if self.kill_at is None:
+            if term and term.is_set():
+                logbook.info('%sCaught TERM signal: stopping' % (self.prefix,))
+            elif self.deadline is not None and now > self.deadline:
+                logbook.info('%sTimed out after %s secs: stopping' % (self.prefix, self.timeout))
+            else:
+                return False
+            self.p.terminate()
+            self.kill_at = now + kill_timeout
+        elif self.p.poll() is not None:
+            # Stopped, but something it started may still hold the pipe open
+            return True
+        elif now > self.kill_at:
+            logbook.info('%sStill running %s secs after SIGTERM: killing' % (self.prefix, kill_timeout))
+            self.p.kill()
+        return False
+
+    def finish(self, abort):
+        if self.partial:
+            self.record(self.partial)
+        self.p.stdout.close()
+        returncode = self.p.wait()
+        outputs = list(self.outputs)
+        if returncode == 0:
+            self.result = outputs
+        else:
+            if abort:
+                abort.set()
+            exc = Exception(self.command, outputs, returncode)
+            logbook.error('%s%s' % (self.prefix, exc))
+
+    def kill(self):
+        "Kill the command if it is still running, and reap it"
+        if self.p.poll() is None:
+            logbook.info('%sKilling' % (self.prefix,))
+            self.p.kill()
+        self.p.stdout.close()
+        self.p.wait()
+
+
+def _run_commands(commands, abort, term, max_parallel, start_check, timeout,
+        kill_timeout, kwargs):
+    if kill_timeout is None:
+        kill_timeout = settings.SUBPROCESS_KILL_TIMEOUT
+    pending = deque(commands)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < (max_parallel or len(commands)):
+                if start_check and ((abort and abort.is_set()) or (term and term.is_set())):
+                    pending.clear()
+                    break
+                command = pending.popleft()
+                command.start(timeout, kwargs)
+                running[command.fd] = command
+            if not running:
+                break
+            readable, _, _ = select(list(running), [], [], SUBPROCESS_POLL_INTERVAL)
+            for fd in readable:
+                if not running[fd].read():
+                    running.pop(fd).finish(abort)
+            now = monotonic()
+            for fd, command in running.items():
+                if command.check_stop(now, term, kill_timeout):
+                    del running[fd]
+                    command.finish(abort)
+    finally:
+        # Only left running if something raised, e.g. a command failed to start
+        for command in running.values():
+            command.kill()
+    return [command.result for command in commands]
+
+def subprocess_run(command, abort, term, log=True, max_lines=None,
+        timeout=None, kill_timeout=None, **kwargs):
+    """Run command, logging each line of its output. Returns the output lines,
+    only the last max_lines of them if given (the log still gets every line).
+
+    The command is sent SIGTERM when term is set or after timeout seconds,
+    then SIGKILL if it is still running kill_timeout seconds later."""
+    commands = [_Command(command, '', log, max_lines)]
+    return _run_commands(commands, abort, term, None, False, timeout,
+            kill_timeout, kwargs)[0]
+
+def subprocess_run_many(commands, abort, term, log=True, max_lines=None,
+        timeout=None, kill_timeout=None, max_parallel=None, **kwargs):
+    """Run commands as subprocess_run would, but all from this thread, with at
+    most max_parallel running at once. Log lines are prefixed with the
+    command's index.
+
+    Returns a list of each command's output lines, with None for any that
+    failed or were not started because abort or term had been set."""
+    commands = [_Command(c, '[%d] ' % (i,), log, max_lines)
+            for i, c in enumerate(commands)]
+    return _run_commands(commands, abort, term, max_parallel, True, timeout,
+            kill_timeout, kwargs)
@@ -28,12 +28,12 @@ class KettleTestCase(TestCase):
         self.log_handler = TestHandler()
         self.log_handler.push_thread()
 
+        # Reset session, first so its open transaction can't block truncation
+        session.Session.remove()
+
         # Truncate all tables
         truncate_all(engine)
 
-        # Reset session
-        session.Session.remove()
-
     def __call__(self, result=None):
         """
         Wrapper around default __call__ method to perform common test set up.
@@ -0,0 +1,38 @@
+from kettle.config import gradual_exec_parallel, make_picker, stage_target
+from kettle.rollout import Rollout
+from kettle.tasks import DelayTask, ParallelExecTask
+from kettle.tests import KettleTestCase, TestTask
+
+class TestConfig(KettleTestCase):
+    def test_stage_target(self):
+        self.assertEqual(stage_target('one', 1000), 1)
+        self.assertEqual(stage_target('half', 1000), 500)
+        self.assertEqual(stage_target('all', 1000), 1000)
+        self.assertEqual(stage_target('1%', 1000), 10)
+        self.assertEqual(stage_target('1%', 50), 1)
+        self.assertEqual(stage_target(25, 1000), 25)
+        self.assertEqual(stage_target(25, 10), 10)
+
+    def test_make_picker(self):
+        picker = make_picker(range(100))
+        self.assertEqual(picker(1), [0])
+        self.assertEqual(picker('5%'), [1, 2, 3, 4])
+        self.assertEqual(picker('3%'), [])
+        self.assertEqual(len(picker('all')), 95)
+
+    def test_gradual_exec_stages(self):
+        rollout = Rollout({})
+        rollout.save()
+        def delays():
+            while True:
+                yield DelayTask(rollout.id, seconds=1)
+        root = gradual_exec_parallel(rollout.id, TestTask, delays(),
+                [((rollout.id,), {})] * 100,
+                stages=(1, '10%', 'all'), max_parallel=(None, 5, 20))
+
+        children = dict((c.id, c) for c in root.children)
+        steps = [children[id] for id in root.state['task_order']]
+        self.assertEqual([type(s) for s in steps], [
+            TestTask, DelayTask, ParallelExecTask, DelayTask, ParallelExecTask])
+        self.assertEqual([len(s.children) for s in steps[2::2]], [9, 90])
+        self.assertEqual([s.state['max_workers'] for s in steps[2::2]], [5, 20])
@@ -0,0 +1,20 @@
+from unittest import TestCase
+
+from sqlalchemy.pool import QueuePool
+
+from kettle.db import create_engine
+
+class TestCreateEngine(TestCase):
+    def test_memory_sqlite_is_one_database(self):
+        for engine_string in 'sqlite://', 'sqlite:///:memory:':
+            engine = create_engine(engine_string)
+            self.assertNotIsInstance(engine.pool, QueuePool)
+            engine.execute('CREATE TABLE t (id INTEGER)')
+            connections = [engine.connect() for _ in range(2)]
+            for connection in connections:
+                self.assertEqual(connection.execute('SELECT COUNT(*) FROM t').scalar(), 0)
+                connection.close()
+
+    def test_file_sqlite_is_pooled(self):
+        engine = create_engine('sqlite:////tmp/kettle_pool_test.sqlite')
+        self.assertIsInstance(engine.pool, QueuePool)
@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+from kettle import events
+from kettle.rollout import Rollout
+from kettle.tests import KettleTestCase, create_task
+
+class TestEventBus(TestCase):
+    def test_publish_to_subscribers(self):
+        bus = events.EventBus(10)
+        subscription = bus.subscribe(1)
+        other = bus.subscribe(2)
+        bus.publish(1, 'task', {'id': 5})
+        self.assertEqual(subscription.get(0), ('task', {'id': 5}))
+        self.assertEqual(other.get(0), None)
+
+    def test_slow_subscriber_dropped(self):
+        bus = events.EventBus(2)
+        subscription = bus.subscribe(1)
+        for i in range(3):
+            bus.publish(1, 'task', {'id': i})
+        self.assertTrue(subscription.overflowed)
+        self.assertFalse(bus._subscriptions)
+
+
+class TestRolloutEvents(KettleTestCase):
+    def test_rollout_publishes(self):
+        rollout = Rollout({})
+        rollout.save()
+        task = create_task(rollout)
+        subscription = events.bus.subscribe(rollout.id)
+        try:
+            rollout.rollout()
+        finally:
+            events.bus.unsubscribe(subscription)
+
+        published = []
+        while True:
+            event = subscription.get(0)
+            if event is None:
+                break
+            published.append(event)
+        self.assertEqual(published, [
+            ('rollout', {'status': 'started'}),
+            ('task', {'id': task.id, 'action': 'run', 'status': 'started', 'error': False}),
+            ('task', {'id': task.id, 'action': 'run', 'status': 'finished', 'error': False}),
+            ('rollout', {'status': 'finished'}),
+            ])
@@ -0,0 +1,112 @@
+import cPickle as pickle
+import json
+
+from mock import patch
+
+from kettle.db import fields, session
+from kettle.db.fields import JSONOrPickle, LazyJSON, MutationDict, encode_dict
+from kettle.rollout import Rollout
+from kettle.tests import KettleTestCase, create_task, engine
+from kettle.tasks import Task
+
+class TestFields(KettleTestCase):
+    def setUp(self):
+        self.rollout = Rollout({})
+        self.rollout.save()
+
+    def load_task(self, task_id):
+        session.Session.expunge_all()
+        return Task._from_id(task_id)
+
+    def test_large_values_load_lazily(self):
+        task = create_task(self.rollout)
+        hosts = ['host%d.example.com' % i for i in range(1000)]
+        task.state['hosts'] = hosts
+        task.state['small'] = 1
+        task.save()
+        task_id = task.id
+
+        task = self.load_task(task_id)
+        self.assertIsInstance(dict.__getitem__(task.state, 'hosts'), LazyJSON)
+        self.assertEqual(task.state['small'], 1)
+        # Saving an unread value keeps it as it was
+        task.state['small'] = 2
+        task.save()
+        task = self.load_task(task_id)
+        self.assertEqual(task.state['hosts'], hosts)
+        self.assertEqual(task.state, {'hosts': hosts, 'small': 2})
+
+    @patch('kettle.settings.JSON_COMPRESS_THRESHOLD', 100)
+    def test_compressed(self):
+        task = create_task(self.rollout)
+        task.state['output'] = 'x' * 1000
+        task.save()
+        raw = engine.execute('SELECT state FROM task WHERE id = %d' % task.id).scalar()
+        self.assertTrue(raw.startswith('z:'))
+        self.assertLess(len(raw), 200)
+        self.assertEqual(self.load_task(task.id).state['output'], 'x' * 1000)
+
+    def test_config_loads_eagerly(self):
+        hosts = ['host%d.example.com' % i for i in range(1000)]
+        self.rollout.config['hosts'] = hosts
+        self.rollout.save()
+        rollout_id = self.rollout.id
+        session.Session.expunge_all()
+        rollout = Rollout._from_id(rollout_id)
+        self.assertEqual(dict(rollout.config), {'hosts': hosts})
+
+    def test_placeholder_shaped_values_kept(self):
+        task = create_task(self.rollout)
+        task.state['value'] = {fields.LAZY_KEY: 'not json'}
+        task.save()
+        task = self.load_task(task.id)
+        self.assertEqual(task.state['value'], {fields.LAZY_KEY: 'not json'})
+
+    def test_stages_reads_pickle(self):
+        stages = JSONOrPickle()
+        self.assertEqual(stages.process_result_value(
+            buffer(pickle.dumps(['one', 'all'], 2)), None), ['one', 'all'])
+        self.assertEqual(stages.process_result_value('["one", "all"]', None),
+                ['one', 'all'])
+
+    def test_read_is_not_a_change(self):
+        state = MutationDict({'hosts': LazyJSON('[1, 2]')})
+        with patch.object(MutationDict, 'changed') as changed:
+            self.assertEqual(state['hosts'], [1, 2])
+        self.assertFalse(changed.called)
+
+    def test_nested_changes_are_saved(self):
+        task = create_task(self.rollout)
+        task.state['progress'] = {'hosts': []}
+        task.save()
+        task.state['progress']['hosts'].append('a')
+        self.assertTrue(session.Session.is_modified(task))
+        task.save()
+        self.assertEqual(self.load_task(task.id).state['progress'], {'hosts': ['a']})
+
+    def test_setting_same_value_is_not_a_change(self):
+        task = create_task(self.rollout)
+        task.state['count'] = 1
+        task.state['hosts'] = ['a']
+        task.save()
+        task.state['count'] = 1
+        task.state['hosts'] = ['a']
+        self.assertFalse(session.Session.is_modified(task))
+        task.state['count'] = True
+        self.assertTrue(session.Session.is_modified(task))
+
+    def test_only_changed_values_encoded(self):
+        state = MutationDict({'hosts': range(100), 'count': 0})
+        encode_dict(state)
+        state['count'] = 1
+        with patch('kettle.db.fields.dumps', wraps=fields.dumps) as dumps:
+            encoded = encode_dict(state)
+        self.assertEqual(sorted(c[0][0] for c in dumps.call_args_list),
+                [1, 'count', 'hosts'])
+        self.assertEqual(json.loads(encoded), {'hosts': range(100), 'count': 1})
+
+    def test_copy_is_plain(self):
+        state = MutationDict({'a': {'b': [1]}})
+        copied = pickle.loads(pickle.dumps(state.copy(), 2))
+        self.assertIs(type(copied['a']['b']), list)
+        self.assertEqual(copied, {'a': {'b': [1]}})
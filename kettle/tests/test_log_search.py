@@ -0,0 +1,58 @@
+from os import path
+from unittest import TestCase
+import shutil
+import tempfile
+
+from mock import patch
+
+from kettle.log_search import LogIndex, indexer, parse_log_name, search
+from kettle.log_utils import multiplexer
+
+class TestLogSearch(TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        patcher = patch('kettle.settings.LOG_DIR', self.log_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = LogIndex(path.join(self.log_dir, 'search.sqlite'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.log_dir)
+
+    def add(self, name, *lines):
+        self.index.add({path.join(self.log_dir, name): [l + '\n' for l in lines]})
+
+    def test_parse_log_name(self):
+        self.assertEqual(parse_log_name('1.rollout'), (1, None, 'rollout'))
+        self.assertEqual(parse_log_name('1.2.run'), (1, 2, 'run'))
+        for name in 'flask', '1.zip.tmp', 'search.sqlite':
+            self.assertIsNone(parse_log_name(name))
+
+    def test_search(self):
+        self.add('1.2.run', 'host a: ok', 'host b: connection refused')
+        self.add('1.3.run', 'host c: ok')
+        self.add('2.4.run', 'host a: connection refused', 'retrying')
+        self.add('2.4.run', 'connection refused again')
+        self.add('flask', 'connection refused')
+
+        results = self.index.search('"connection refused"')
+        self.assertEqual([(r['name'], r['task_id'], r['count']) for r in results],
+                [('2.4.run', 4, 2), ('1.2.run', 2, 1)])
+        self.assertEqual(results[0]['lines'],
+                ['host a: connection refused', 'connection refused again'])
+
+        self.assertEqual([r['name'] for r in self.index.search('refused', [1])], ['1.2.run'])
+        self.assertEqual([r['name'] for r in self.index.search('refused', last=1)], ['2.4.run'])
+        self.assertEqual([r['name'] for r in self.index.search('ok NOT a')], ['1.3.run'])
+        self.assertEqual(self.index.search('refused', max_lines=1)[0]['lines'],
+                ['host a: connection refused'])
+
+    def test_multiplexer_indexes(self):
+        multiplexer.write(path.join(self.log_dir, '5.rollout'), 'Rollout started\n')
+        multiplexer.write(path.join(self.log_dir, '5.6.run'), 'caf\xc3\xa9 failed\n')
+        multiplexer.flush()
+        indexer.flush()
+        self.assertEqual([(r['name'], r['lines']) for r in search('failed')],
+                [('5.6.run', [u'caf\xe9 failed'])])
+        self.assertEqual(search('started', [6]), [])
@@ -0,0 +1,173 @@
+from StringIO import StringIO
+from contextlib import closing
+from os import path
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+
+import logbook
+from mock import patch
+
+from kettle.log_utils import (
+        LogMultiplexer, MultiplexedFileHandler, archive_filename, archive_logs,
+        follow_file, iter_file, multiplexer, open_log, safe_log_filename,
+        tail_offset)
+
+class TestLogFiles(TestCase):
+    def test_tail_offset(self):
+        f = StringIO(''.join('line %d\n' % i for i in range(1000)))
+        for chunk_size in 7, 1024:
+            offset = tail_offset(f, 2, chunk_size=chunk_size)
+            f.seek(offset)
+            self.assertEqual(f.read(), 'line 998\nline 999\n')
+        self.assertEqual(tail_offset(f, 5000), 0)
+
+    def test_tail_offset_no_trailing_newline(self):
+        f = StringIO('a\nb\nc')
+        f.seek(tail_offset(f, 2))
+        self.assertEqual(f.read(), 'b\nc')
+
+    def test_iter_file(self):
+        f = StringIO('0123456789')
+        self.assertEqual(list(iter_file(f, 2, 5, chunk_size=2)), ['23', '45', '6'])
+
+    def test_follow_file(self):
+        f = StringIO('abc')
+        live = [True, False]
+        def is_live():
+            if live[0]:
+                f.seek(0, 2)
+                f.write('def')
+            return live.pop(0)
+        self.assertEqual(''.join(follow_file(f, 1, is_live, 0)), 'bcdef')
+
+    def test_safe_log_filename(self):
+        self.assertTrue(safe_log_filename(1, 2, 'run').endswith('1.2.run'))
+        for bad in '..', '.hidden', 'a/b', '':
+            self.assertRaises(ValueError, safe_log_filename, 1, bad)
+
+
+class TestLogMultiplexer(TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def read(self, name):
+        with open(path.join(self.log_dir, name)) as f:
+            return f.read()
+
+    @patch('kettle.settings.LOG_MAX_OPEN_FILES', 2)
+    def test_writes_with_bounded_open_files(self):
+        mux = LogMultiplexer()
+        for i in range(20):
+            for name in 'abcde':
+                mux.write(path.join(self.log_dir, name), '%d\n' % (i,))
+        mux.flush()
+        self.assertLessEqual(len(mux._files), 2)
+        for name in 'abcde':
+            self.assertEqual(self.read(name), ''.join('%d\n' % i for i in range(20)))
+
+    def test_survives_batch_errors(self):
+        mux = LogMultiplexer()
+        with patch.object(mux, '_index', side_effect=Exception('index broken')):
+            mux.write(path.join(self.log_dir, 'a'), 'one\n')
+            mux.flush()
+        mux.write(path.join(self.log_dir, 'a'), 'two\n')
+        mux.flush()
+        self.assertEqual(self.read('a'), 'one\ntwo\n')
+
+    @patch('kettle.log_utils.LOG_FLUSH_CHECK_INTERVAL', 0.01)
+    def test_flush_returns_if_thread_died(self):
+        mux = LogMultiplexer()
+        with patch.object(mux, '_run', side_effect=SystemExit):
+            mux.write(path.join(self.log_dir, 'a'), 'one\n')
+            mux._thread.join(5)
+        with patch('sys.stderr') as stderr:
+            mux.flush()
+        self.assertTrue(stderr.write.called)
+        # Don't report it again from the atexit flush
+        mux._thread = None
+
+    def test_handler(self):
+        filename = path.join(self.log_dir, 'task')
+        handler = MultiplexedFileHandler(filename, format_string=u'{record.message}')
+        with handler.threadbound():
+            logbook.info(u'caf\xe9')
+        multiplexer.flush()
+        self.assertEqual(self.read('task'), 'caf\xc3\xa9\n')
+
+
+class TestLogArchive(TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        for patcher in (patch('kettle.settings.LOG_DIR', self.log_dir),
+                patch('kettle.settings.LOG_SEARCH_INDEX', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def write(self, name, data):
+        multiplexer.write(path.join(self.log_dir, name), data)
+
+    def read_log(self, *args):
+        f, size = open_log(*args)
+        data = f.read()
+        self.assertEqual(len(data), size)
+        return data
+
+    def test_archive_logs(self):
+        self.write('1.rollout', 'rollout\n')
+        self.write('1.2.run', 'run\n')
+        self.write('10.rollout', 'other\n')
+        archive_logs(1)
+
+        self.assertEqual(sorted(os.listdir(self.log_dir)), ['1.zip', '10.rollout'])
+        self.assertEqual(self.read_log(1, 'rollout'), 'rollout\n')
+        self.assertEqual(self.read_log(1, 2, 'run'), 'run\n')
+        self.assertEqual(self.read_log(10, 'rollout'), 'other\n')
+        self.assertIsNone(open_log(1, 'rollback'))
+
+    def test_archive_logs_again(self):
+        self.write('1.rollout', 'one\n')
+        self.write('1.2.run', 'run\n')
+        archive_logs(1)
+        self.write('1.rollout', 'two\n')
+        self.write('1.rollback', 'back\n')
+        archive_logs(1)
+
+        self.assertEqual(os.listdir(self.log_dir), ['1.zip'])
+        with closing(zipfile.ZipFile(archive_filename(1))) as archive:
+            self.assertEqual([n for n in archive.namelist() if '/' not in n],
+                    ['1.2.run', '1.rollout', '1.rollback', '1.rollout~2'])
+        self.assertEqual(self.read_log(1, 'rollout'), 'one\ntwo\n')
+        self.assertEqual(self.read_log(1, 2, 'run'), 'run\n')
+        self.assertEqual(self.read_log(1, 'rollback'), 'back\n')
+
+    @patch('kettle.log_utils.ARCHIVE_BLOCK_SIZE', 1000)
+    def test_large_archived_log_read_in_blocks(self):
+        lines = ''.join('line %d\n' % i for i in range(20000))
+        self.write('1.rollout', lines[:50000])
+        archive_logs(1)
+        self.write('1.rollout', lines[50000:])
+        archive_logs(1)
+
+        f, size = open_log(1, 'rollout')
+        self.assertEqual(size, len(lines))
+        with patch('kettle.log_utils.zlib.decompress', wraps=zlib.decompress) as decompress:
+            f.seek(tail_offset(f, 2, chunk_size=1000))
+            self.assertEqual(f.read(), 'line 19998\nline 19999\n')
+            # Only the last blocks, not the whole log
+            self.assertLessEqual(decompress.call_count, 3)
+            decompress.reset_mock()
+            # A range across the two parts
+            self.assertEqual(''.join(iter_file(f, 49990, 20)), lines[49990:50010])
+            self.assertEqual(decompress.call_count, 2)
+        self.assertEqual(''.join(iter_file(f, chunk_size=777)), lines)
+        f.close()
@@ -1,8 +1,15 @@
-from threading import Event
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+import time
 
+from mock import patch
+
+from sqlalchemy import event
+
+from kettle.db import session
 from kettle.rollout import Rollout
-from kettle.tasks import ParallelExecTask, SequentialExecTask, Task
-from kettle.tests import KettleTestCase, create_task, TestTask
+from kettle.tasks import ParallelExecTask, SequentialExecTask, Task, TaskTreeBuilder
+from kettle.tests import KettleTestCase, create_task, engine, TestTask
 
 
 class TestTaskFail(TestTask):
@@ -10,6 +17,11 @@ class TestTaskFail(TestTask):
     def _run(cls, state, children, abort, term):
         raise Exception
 
+class TestTaskRevertFail(TestTask):
+    @classmethod
+    def _revert(cls, state, children, abort, term):
+        raise Exception('revert failed')
+
 class TestRollout(KettleTestCase):
     def test_init(self):
         rollout = Rollout({})
@@ -28,6 +40,84 @@ class TestRollout(KettleTestCase):
         rollout.generate_tasks()
         self.assertEqual(len(rollout.tasks), 1)
 
+    def test_generate_tasks_bulk_insert(self):
+        class TreeRollout(Rollout):
+            def _generate_tasks(self):
+                tasks = [TestTask(self.id) for _ in range(4)]
+                parallel = ParallelExecTask(self.id, tasks[1:])
+                SequentialExecTask(self.id, [tasks[0], parallel]).save()
+
+        rollout = TreeRollout({})
+        rollout.save()
+
+        inserts = []
+        def record(conn, cursor, statement, *args):
+            if statement.startswith('INSERT'):
+                inserts.append(statement)
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            rollout.generate_tasks()
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        self.assertEqual(len(inserts), 1)
+        root = rollout.load_task_tree()
+        children = {child.id: child for child in root.children}
+        first, parallel = [children[id] for id in root.state['task_order']]
+        self.assertIsInstance(first, TestTask)
+        self.assertIsInstance(parallel, ParallelExecTask)
+        self.assertEqual(len(parallel.children), 3)
+
+    def test_generate_tasks_pending_id_raises(self):
+        class IdRollout(Rollout):
+            def _generate_tasks(self):
+                task = TestTask(self.id)
+                task.save()
+                root = TestTask(self.id)
+                root.state['first_id'] = task.id
+                root.save()
+
+        rollout = IdRollout({})
+        rollout.save()
+        self.assertRaises(Exception, rollout.generate_tasks)
+        with TaskTreeBuilder():
+            task = TestTask(rollout.id)
+            task.save()
+            self.assertRaises(Exception, int, task.id)
+            self.assertRaises(Exception, lambda: task.id == 1)
+        self.assertIsInstance(task.id, int)
+
+    def test_generate_tasks_concurrently(self):
+        class TreeRollout(Rollout):
+            def _generate_tasks(self):
+                tasks = [TestTask(self.id) for _ in range(20)]
+                # Let the other threads read the max id too
+                time.sleep(0.05)
+                SequentialExecTask(self.id, tasks).save()
+
+        ids = []
+        for _ in range(4):
+            rollout = TreeRollout({})
+            rollout.save()
+            ids.append(rollout.id)
+        errors = []
+        def generate(rollout_id):
+            try:
+                session.Session.query(TreeRollout).get(rollout_id).generate_tasks()
+            except Exception, e:
+                errors.append(e)
+            finally:
+                session.Session.remove()
+        threads = [Thread(target=generate, args=(id,)) for id in ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for rollout_id in ids:
+            self.assertEqual(session.Session.query(Task).filter_by(rollout_id=rollout_id).count(), 21)
+
     def test_generate_tasks_after_run(self):
         rollout = Rollout({})
         rollout.save()
@@ -36,6 +126,85 @@ class TestRollout(KettleTestCase):
 
         self.assertRaises(Exception, rollout.generate_tasks)
 
+    def test_load_task_tree(self):
+        rollout = Rollout({})
+        rollout.save()
+        task1 = create_task(rollout)
+        task2 = create_task(rollout)
+        task3 = create_task(rollout)
+        parent = create_task(rollout, ParallelExecTask, [task2, task3])
+        root = create_task(rollout, SequentialExecTask, [task1, parent])
+        rollout_id = rollout.id
+        ids = [t.id for t in task1, task2, task3, parent]
+        session.Session.expunge_all()
+
+        statements = []
+        def count(*args):
+            statements.append(args)
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            root = Rollout._from_id(rollout_id).load_task_tree()
+            loaded = len(statements)
+            root.friendly_str()
+            [child.status() for child in root.children]
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        self.assertEqual(len(statements), loaded)
+        task1_id, task2_id, task3_id, parent_id = ids
+        self.assertEqual(root.state['task_order'], [task1_id, parent_id])
+        self.assertEqual([c.id for c in root.children[1].children], [task2_id, task3_id])
+        self.assertIs(root.children[0].parent, root)
+
+    def test_tasks_changed_since(self):
+        rollout = Rollout({})
+        rollout.save()
+        task1 = create_task(rollout)
+        task2 = create_task(rollout)
+        since = datetime.now()
+        task2.state['touched'] = True
+        task2.save()
+
+        self.assertEqual(rollout.tasks_changed_since(), [task1, task2])
+        self.assertEqual(rollout.tasks_changed_since(since), [task2])
+
+    def test_history_query(self):
+        now = datetime.now()
+        def make(user, **dts):
+            rollout = Rollout({})
+            rollout.user = user
+            for name, dt in dts.iteritems():
+                setattr(rollout, name, dt)
+            rollout.save()
+            return rollout
+        statuses = [
+            ('queued', make('a', queued_dt=now)),
+            ('not_started', make('b')),
+            ('started', make('a', rollout_start_dt=now)),
+            ('finished', make('b', rollout_start_dt=now, rollout_finish_dt=now)),
+            ('rolling_back', make('a', rollout_start_dt=now - timedelta(days=2),
+                rollout_finish_dt=now, rollback_start_dt=now)),
+            ('rolled_back', make('b', rollout_start_dt=now, rollout_finish_dt=now,
+                rollback_start_dt=now, rollback_finish_dt=now)),
+        ]
+        hidden = make('a')
+        hidden.hidden = True
+        hidden.save()
+
+        def ids(**kwargs):
+            return [r.id for r, _ in Rollout.history_query(**kwargs)]
+        expected = [r.id for _, r in reversed(statuses)]
+        self.assertEqual(ids(), expected)
+        self.assertEqual([(s, r.id) for r, s in Rollout.history_query()],
+                [(s, r.id) for s, r in reversed(statuses)])
+        for status, rollout in statuses:
+            self.assertEqual(rollout.status(), status)
+        self.assertEqual(ids(before=expected[1])[:2], expected[2:4])
+        self.assertEqual(ids(user='a'), [statuses[i][1].id for i in (4, 2, 0)])
+        self.assertEqual(ids(statuses=['finished', 'rolled_back']), [expected[0], expected[2]])
+        self.assertEqual(ids(since=now - timedelta(days=1)), [expected[0], expected[2], expected[3]])
+        self.assertEqual(ids(until=now - timedelta(days=1)), [expected[1]])
+
     def test_single_task_rollout(self):
         rollout = Rollout({})
         rollout.save()
@@ -104,6 +273,33 @@ class TestRollout(KettleTestCase):
     def test_parallel_exec_rollout_nested(self):
         self._test_exec_rollout_nested(ParallelExecTask)
 
+    def test_parallel_exec_max_workers(self):
+        lock = Lock()
+        running = [0]
+        peak = [0]
+
+        class CountingTask(TestTask):
+            @classmethod
+            def _run(cls, state, children, abort, term):
+                with lock:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                time.sleep(0.1)
+                with lock:
+                    running[0] -= 1
+
+        rollout = Rollout({})
+        rollout.save()
+        tasks = [create_task(rollout, CountingTask) for _ in range(6)]
+        root = create_task(rollout, ParallelExecTask, tasks, max_workers=2)
+
+        rollout.rollout()
+
+        for task in tasks:
+            self.assertRun(task)
+            self.assertNotReverted(task)
+        self.assertEqual(peak[0], 2)
+
     def test_sequential_quit_and_rollback_on_failure(self):
         class RecordedRollout(Rollout):
             rollback_calls = []
@@ -176,3 +372,116 @@ class TestRollout(KettleTestCase):
         self.assertEqual(MonitoredRollout.rollback_calls, [rollout])
         self.assertReverted(task_run)
         self.assertReverted(task_wake_monitor_wait)
+
+    def _make_interrupted_rollout(self):
+        rollout = Rollout({})
+        rollout.save()
+        task1 = create_task(rollout)
+        task2 = create_task(rollout)
+        task3 = create_task(rollout)
+        root = create_task(rollout, SequentialExecTask, [task1, task2, task3])
+        # As left by a process that died while running task2
+        now = datetime.now()
+        rollout.rollout_start_dt = now
+        root.run_start_dt = now
+        task1.run_start_dt = task1.run_return_dt = now
+        task2.run_start_dt = now
+        rollout.save()
+        return rollout, task1, task2, task3
+
+    def test_crash_before_rollback_is_orphaned(self):
+        class CrashingRollout(Rollout):
+            def rollback(self):
+                raise SystemExit
+        rollout = CrashingRollout({})
+        rollout.save()
+        create_task(rollout, SequentialExecTask, [create_task(rollout, TestTaskFail)])
+        self.assertRaises(SystemExit, rollout.rollout)
+        self.assertEqual([r.id for r in Rollout.orphaned_query()], [rollout.id])
+
+    def test_orphaned_query(self):
+        rollout = self._make_interrupted_rollout()[0]
+        self.assertEqual([r.id for r in Rollout.orphaned_query()], [rollout.id])
+
+    def test_resume(self):
+        rollout, task1, task2, task3 = self._make_interrupted_rollout()
+
+        Rollout._resume(rollout.id, 'resume')
+
+        self.assertNotRun(task1)
+        self.assertRun(task2)
+        self.assertRun(task3)
+        self.assertEqual(rollout.status(), 'finished')
+        self.assertFalse(Rollout.orphaned_query().all())
+
+    def test_resume_rollback_policy(self):
+        rollout, task1, task2, task3 = self._make_interrupted_rollout()
+
+        Rollout._resume(rollout.id, 'rollback')
+
+        self.assertNotRun(task3)
+        self.assertReverted(task1)
+        self.assertReverted(task2)
+        self.assertNotReverted(task3)
+        self.assertEqual(rollout.status(), 'rolled_back')
+
+    def test_resume_interrupted_rollback(self):
+        rollout, task1, task2, task3 = self._make_interrupted_rollout()
+        now = datetime.now()
+        rollout.rollout_finish_dt = rollout.rollback_start_dt = now
+        task2.run_return_dt = now
+        task2.revert_start_dt = task2.revert_return_dt = now
+        rollout.save()
+
+        Rollout._resume(rollout.id, 'resume')
+
+        self.assertNotReverted(task2)
+        self.assertReverted(task1)
+        self.assertEqual(rollout.status(), 'rolled_back')
+
+    def test_parallel_revert_continues_and_aggregates(self):
+        rollout = Rollout({})
+        rollout.save()
+        task_ok = create_task(rollout)
+        task_fail1 = create_task(rollout, TestTaskRevertFail)
+        task_fail2 = create_task(rollout, TestTaskRevertFail)
+        group = create_task(rollout, ParallelExecTask,
+                [task_ok, task_fail1, task_fail2], continue_on_error=True)
+        task_error = create_task(rollout, TestTaskFail)
+        root = create_task(rollout, SequentialExecTask, [group, task_error])
+
+        self.assertRaises(Exception, rollout.rollout)
+
+        for task in task_ok, task_fail1, task_fail2, task_error:
+            self.assertReverted(task)
+        group = Task._from_id(group.id)
+        session.Session.refresh(group)
+        self.assertIn('2 of 3 tasks failed', group.revert_error)
+        self.assertEqual(sorted(group.state['failed_task_ids']),
+                sorted([task_fail1.id, task_fail2.id]))
+        self.assertEqual(rollout.status(), 'rollback_failed')
+        self.assertIsNone(rollout.rollback_finish_dt)
+        self.assertEqual([r.id for r in Rollout.orphaned_query()], [rollout.id])
+        self.assertEqual([s for _, s in Rollout.history_query()], ['rollback_failed'])
+
+        # Resuming retries the failed reverts
+        with patch.object(TestTaskRevertFail, '_revert',
+                classmethod(TestTask._revert.im_func)):
+            Rollout._resume(rollout.id, 'resume')
+        session.Session.refresh(rollout)
+        self.assertEqual(rollout.status(), 'rolled_back')
+
+    def test_sequential_revert_continues(self):
+        rollout = Rollout({})
+        rollout.save()
+        task1 = create_task(rollout)
+        task_revert_fail = create_task(rollout, TestTaskRevertFail)
+        task_error = create_task(rollout, TestTaskFail)
+        root = create_task(rollout, SequentialExecTask,
+                [task1, task_revert_fail, task_error], continue_on_error=True)
+
+        self.assertRaises(Exception, rollout.rollout)
+
+        self.assertReverted(task_error)
+        self.assertReverted(task_revert_fail)
+        self.assertReverted(task1)
@@ -0,0 +1,86 @@
+from os import path
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock import patch
+
+import kettle
+from kettle.rollout import Rollout
+from kettle.signals import DBSignalBackend, FileSignalBackend
+from kettle.db import session
+from kettle.tests import KettleTestCase
+from kettle.thread_utils import wait_any
+
+class SignalBackendTests(object):
+    backend_cls = None
+
+    def setUp(self):
+        rollout = Rollout({})
+        rollout.save()
+        self.rollout_id = rollout.id
+        # One backend running the rollout, one standing in for another process
+        self.runner = self.backend_cls()
+        self.other = self.backend_cls()
+        self.runner.make(self.rollout_id, 'abort_rollout')
+        self.addCleanup(self.runner.stop)
+
+    def test_remote_set_reaches_runner(self):
+        remote = self.other.get(self.rollout_id, 'abort_rollout')
+        self.assertFalse(remote.is_set())
+        remote.set()
+        local = self.runner.get(self.rollout_id, 'abort_rollout')
+        self.assertTrue(wait_any((local,), timeout=2))
+
+    def test_local_set_written(self):
+        self.runner.get(self.rollout_id, 'abort_rollout').set()
+        for _ in range(40):
+            if self.other.get(self.rollout_id, 'abort_rollout').is_set():
+                break
+            time.sleep(0.05)
+        self.assertTrue(self.other.get(self.rollout_id, 'abort_rollout').is_set())
+
+    def test_stop_writes_local_sets(self):
+        self.runner.get(self.rollout_id, 'abort_rollout').set()
+        self.runner.stop()
+        self.assertIsNone(self.runner._watcher)
+        self.assertTrue(self.other.get(self.rollout_id, 'abort_rollout').is_set())
+
+    def test_delete(self):
+        self.runner.delete(self.rollout_id, 'abort_rollout')
+        self.assertIsNone(self.runner.get(self.rollout_id, 'abort_rollout'))
+        self.assertIsNone(self.other.get(self.rollout_id, 'abort_rollout'))
+
+
+@patch('kettle.settings.SIGNAL_POLL_INTERVAL', 0.05)
+class TestDBSignalBackend(SignalBackendTests, KettleTestCase):
+    backend_cls = DBSignalBackend
+
+
+@patch('kettle.settings.SIGNAL_POLL_INTERVAL', 0.05)
+class TestFileSignalBackend(SignalBackendTests, KettleTestCase):
+    backend_cls = FileSignalBackend
+
+    def setUp(self):
+        self.signal_dir = tempfile.mkdtemp()
+        patcher = patch('kettle.settings.SIGNAL_DIR', self.signal_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.signal_dir)
+        super(TestFileSignalBackend, self).setUp()
+
+    def test_set_from_another_process(self):
+        script = (
+            'from kettle import settings\n'
+            'settings.SIGNAL_DIR = %r\n'
+            'from kettle.signals import FileSignalBackend\n'
+            'FileSignalBackend().get(%d, "abort_rollout").set()\n') % (
+                self.signal_dir, self.rollout_id)
+        root = path.dirname(path.dirname(kettle.__file__))
+        env = dict(os.environ, PYTHONPATH=root)
+        subprocess.check_call([sys.executable, '-c', script], env=env)
+        local = self.runner.get(self.rollout_id, 'abort_rollout')
+        self.assertTrue(wait_any((local,), timeout=2))
@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+from mock import patch
+
+from kettle.db import session
+from kettle.db.writer import writer
+from kettle.rollout import Rollout
+from kettle.summary import TaskSummary, dashboard, median
+from kettle.tasks import ParallelExecTask, SequentialExecTask
+from kettle.tests import KettleTestCase, TestTask, create_task
+
+class FailTask(TestTask):
+    @classmethod
+    def _run(cls, state, children, abort, term):
+        raise Exception('failed')
+
+
+class TestSummary(KettleTestCase):
+    def setUp(self):
+        self.rollout = Rollout({})
+        self.rollout.rollout_start_dt = datetime.now()
+        self.rollout.save()
+
+    def summaries(self):
+        session.Session.expire_all()
+        return dict(((s.rollout_id, s.task_type), (s.run_ok, s.run_failed, s.revert_ok))
+                for s in session.Session.query(TaskSummary))
+
+    def run_tasks(self):
+        for task_cls in TestTask, TestTask, FailTask:
+            task = create_task(self.rollout, task_cls)
+            try:
+                task.run()
+            except Exception:
+                pass
+        task.revert()
+        writer.flush()
+
+    def test_record_action(self):
+        self.run_tasks()
+        self.assertEqual(self.summaries(), {
+            (self.rollout.id, 'TestTask'): (2, 0, 0),
+            (self.rollout.id, 'FailTask'): (0, 1, 1)})
+
+    def test_exec_tasks_not_recorded(self):
+        inner = create_task(self.rollout, ParallelExecTask,
+                [create_task(self.rollout) for _ in range(2)])
+        outer = create_task(self.rollout, SequentialExecTask,
+                [create_task(self.rollout), inner])
+        self.rollout._setup_signals_rollout()
+        try:
+            outer.run()
+        finally:
+            self.rollout._teardown_signals_rollout()
+        writer.flush()
+        self.assertEqual(self.summaries(), {(self.rollout.id, 'TestTask'): (3, 0, 0)})
+        # Nor shown, if recorded before they were left out
+        key = (('rollout_id', self.rollout.id), ('task_type', 'SequentialExecTask'))
+        writer.increment(TaskSummary.__table__, key, {'run_ok': 1, 'run_secs': 60}, wait=True)
+        self.assertEqual([t for t, _, _, _ in dashboard(Rollout)['slowest']], ['TestTask'])
+
+    @patch('kettle.settings.TASK_SAVE_INTERVAL', None)
+    def test_record_action_without_write_behind(self):
+        self.run_tasks()
+        self.assertEqual(self.summaries()[(self.rollout.id, 'TestTask')], (2, 0, 0))
+
+    def test_increments_coalesce(self):
+        key = (('rollout_id', self.rollout.id), ('task_type', 'TestTask'))
+        writer.increment(TaskSummary.__table__, key, {'run_ok': 1, 'run_secs': 1.5})
+        writer.increment(TaskSummary.__table__, key, {'run_ok': 2, 'run_secs': 1})
+        writer.flush()
+        writer.increment(TaskSummary.__table__, key, {'run_failed': 1}, wait=True)
+        summary = session.Session.query(TaskSummary).one()
+        self.assertEqual((summary.run_ok, summary.run_failed, summary.run_secs), (3, 1, 2.5))
+
+    def test_dashboard(self):
+        now = datetime.now()
+        self.rollout.rollout_finish_dt = self.rollout.rollout_start_dt + timedelta(seconds=10)
+        self.rollout.save()
+        for start_dt, secs, rolled_back in (
+                (now, 30, False), (now, 5, True), (now - timedelta(days=40), 1, False)):
+            rollout = Rollout({})
+            rollout.rollout_start_dt = start_dt
+            rollout.rollout_finish_dt = start_dt + timedelta(seconds=secs)
+            if rolled_back:
+                rollout.rollback_start_dt = rollout.rollback_finish_dt = now
+            rollout.save()
+        self.run_tasks()
+
+        figures = dashboard(Rollout, days=30)
+        self.assertEqual(figures['total'], 3)
+        self.assertEqual(figures['counts'], {'finished': 2, 'rolled_back': 1})
+        self.assertAlmostEqual(figures['rollback_rate'], 1 / 3.0)
+        self.assertEqual(figures['median_secs'], 20)
+        self.assertEqual(sorted((t, runs, failed) for t, runs, failed, _ in figures['slowest']),
+                [('FailTask', 1, 1), ('TestTask', 2, 0)])
+
+    def test_median(self):
+        self.assertIsNone(median([]))
+        self.assertEqual(median([3, 1, 2]), 2)
+        self.assertEqual(median([4, 1, 2, 3]), 2.5)
@@ -1,13 +1,48 @@
 from collections import defaultdict
 from datetime import datetime
+from threading import Timer
+import os
+import signal
 import time
 
 from mock import patch, Mock
 
+from kettle import tasks
 from kettle.db import session
+from kettle.db.writer import writer
 from kettle.rollout import Rollout
-from kettle.tasks import Task, DelayTask, SequentialExecTask, ParallelExecTask
-from kettle.tests import KettleTestCase, TestTask, create_task
+from kettle.tasks import (
+        Task, DelayTask, HealthGatedDelayTask, SequentialExecTask, ParallelExecTask,
+        ParallelCommandTask, subprocess_run, subprocess_run_many)
+from kettle.tests import KettleTestCase, TestTask, create_task, engine
+from kettle.thread_utils import NotifyingEvent
+
+class ProcessTask(Task):
+    run_in_process = True
+
+    @classmethod
+    def _run(cls, state, children, abort, term):
+        state['pid'] = os.getpid()
+        if state.get('fail'):
+            abort.set()
+        return 'ran'
+
+
+class DyingProcessTask(Task):
+    run_in_process = True
+
+    @classmethod
+    def _run(cls, state, children, abort, term):
+        if state.get('hang'):
+            time.sleep(60)
+        os.kill(os.getpid(), signal.SIGKILL)
+
+
+class LongFailTask(Task):
+    @classmethod
+    def _run(cls, state, children, abort, term):
+        raise Exception('host unreachable ' * 50)
+
 
 class TestTasks(KettleTestCase):
     def setUp(self):
@@ -119,6 +154,250 @@ class TestTasks(KettleTestCase):
 
         _run_mock.assert_not_called()
 
+    def test_many_failures_fit_error_column(self):
+        children = [create_task(self.rollout, LongFailTask) for _ in range(20)]
+        parent = create_task(self.rollout, ParallelExecTask, children)
+        self.rollout._setup_signals_rollout()
+        try:
+            self.assertRaises(Exception, parent.run)
+        finally:
+            self.rollout._teardown_signals_rollout()
+        self.assertRegexpMatches(parent.run_error, r'^\d+ of 20 tasks failed: ')
+        self.assertLessEqual(len(parent.run_error), 500)
+        self.assertLessEqual(len(parent.run_traceback), 1000)
+        writer.flush()
+        rows = engine.execute(Task.__table__.select().where(
+            Task.__table__.c.run_error_dt != None)).fetchall()
+        self.assertIn(parent.id, [row.id for row in rows])
+        self.assertTrue(all(len(row.run_error) <= 500 for row in rows))
+
+    def test_raise_failures_names_first_few(self):
+        failures = [(Mock(id=i), (Exception, Exception('x' * 100), None))
+                for i in range(200)]
+        state = {}
+        with self.assertRaises(Exception) as raised:
+            ParallelExecTask.raise_failures(state, failures, 300)
+        message = raised.exception.message
+        self.assertTrue(message.startswith('200 of 300 tasks failed: 0: x'))
+        self.assertTrue(message.endswith('; and 195 more'))
+        self.assertLessEqual(len(message), 500)
+        self.assertEqual(state['failed_task_ids'], range(200))
+
+
+class TestRunInProcess(KettleTestCase):
+    def setUp(self):
+        self.rollout = Rollout({})
+        self.rollout.save()
+        self.rollout_id = self.rollout.id
+        self.rollout._setup_signals_rollout()
+
+    def tearDown(self):
+        self.rollout._teardown_signals_rollout()
+        super(TestRunInProcess, self).tearDown()
+
+    def test_run(self):
+        task = ProcessTask(self.rollout_id)
+        task.save()
+        task.run()
+        self.assertEqual(task.run_return, 'ran')
+        self.assertNotEqual(task.state['pid'], os.getpid())
+        self.assertFalse(Rollout.get_signal(self.rollout_id, 'abort_rollout').is_set())
+
+    def test_abort_passed_back(self):
+        task = ProcessTask(self.rollout_id)
+        task.state['fail'] = True
+        task.save()
+        task.run()
+        self.assertTrue(Rollout.get_signal(self.rollout_id, 'abort_rollout').is_set())
+
+    @patch('kettle.process_utils.PROCESS_POLL_INTERVAL', 0.05)
+    def test_process_dies(self):
+        task = DyingProcessTask(self.rollout_id)
+        task.save()
+        self.assertRaises(Exception, task.run)
+        self.assertIn('died', task.run_error)
+
+    @patch('kettle.process_utils.PROCESS_POLL_INTERVAL', 0.05)
+    @patch('kettle.settings.PROCESS_TASK_TIMEOUT', 0.5)
+    def test_timeout(self):
+        task = DyingProcessTask(self.rollout_id)
+        task.state['hang'] = True
+        task.save()
+        start = time.time()
+        self.assertRaises(Exception, task.run)
+        self.assertIn('Timed out', task.run_error)
+        self.assertLess(time.time() - start, 10)
+
+
+class TestWriteBehind(KettleTestCase):
+    def setUp(self):
+        self.rollout = Rollout({})
+        self.rollout.save()
+
+    def db_row(self, task):
+        return engine.execute(Task.__table__.select().where(
+            Task.__table__.c.id == task.id)).first()
+
+    def test_save_behind_wait_is_durable(self):
+        task = create_task(self.rollout)
+        task.run_start_dt = datetime.now()
+        task.save_behind(wait=True)
+        self.assertTrue(self.db_row(task).run_start_dt)
+        self.assertFalse(session.Session.is_modified(task))
+
+    def test_save_behind_coalesces(self):
+        task = create_task(self.rollout)
+        with patch.object(writer, 'update', wraps=writer.update) as update:
+            task.state['count'] = 1
+            task.save_behind()
+            task.state['count'] = 2
+            task.save_behind()
+            task.save_behind()
+            self.assertEqual(update.call_count, 2)
+        writer.flush()
+        self.assertEqual(self.db_row(task).state, {'count': 2})
+
+    def test_save_behind_releases_connection(self):
+        task = create_task(self.rollout)
+        session.Session.query(Task).all()
+        task.run_start_dt = datetime.now()
+        task.save_behind()
+        self.assertFalse(session.Session().transaction._connections)
+        self.assertIn('run_start_dt', task.__dict__)
+
+    @patch('kettle.settings.WRITE_MAX_ATTEMPTS', 2)
+    def test_writer_drops_bad_row(self):
+        good, bad = create_task(self.rollout), create_task(self.rollout)
+        writer.update(Task.__table__, bad.id, {'run_return': object()})
+        writer.update(Task.__table__, good.id, {'run_return': 'ok'})
+        self.assertRaises(Exception, writer.flush)
+        self.assertEqual(self.db_row(good).run_return, 'ok')
+        self.assertRaises(Exception, writer.flush)
+        # Dropped after its second failure
+        writer.update(Task.__table__, good.id, {'run_return': 'again'}, wait=True)
+        self.assertEqual(self.db_row(good).run_return, 'again')
+        self.assertEqual(self.db_row(bad).run_return, None)
+
+    def test_writer_stop_writes_queued(self):
+        task = create_task(self.rollout)
+        writer.update(Task.__table__, task.id, {'run_return': 'ok'})
+        writer.stop()
+        self.assertEqual(self.db_row(task).run_return, 'ok')
+        # Updates after a stop start it again
+        writer.update(Task.__table__, task.id, {'run_return': 'again'}, wait=True)
+        self.assertEqual(self.db_row(task).run_return, 'again')
+
+    @patch('kettle.settings.TASK_SAVE_INTERVAL', None)
+    def test_save_behind_disabled(self):
+        task = create_task(self.rollout)
+        task.state['count'] = 1
+        with patch.object(writer, 'update') as update:
+            task.save_behind()
+            self.assertFalse(update.called)
+        self.assertEqual(self.db_row(task).state, {'count': 1})
+
+class TestDelayTask(KettleTestCase):
+    def test_wait_sub_second(self):
+        elapsed = DelayTask.wait(0.2, NotifyingEvent(), NotifyingEvent())
+        self.assertGreaterEqual(elapsed, 0.2)
+        self.assertLess(elapsed, 1)
+
+    def test_wait_wakes_on_abort(self):
+        abort = NotifyingEvent()
+        Timer(0.05, abort.set).start()
+        elapsed = DelayTask.wait(15, abort, NotifyingEvent())
+        self.assertLess(elapsed, 1)
+
+    def test_run_records_waited(self):
+        state = {'seconds': 0.1, 'reversible': False}
+        DelayTask._run(state, [], NotifyingEvent(), NotifyingEvent())
+        self.assertGreaterEqual(state['run_waited'], 0.1)
+
+    def test_min_sec_str(self):
+        self.assertEqual(DelayTask.min_sec_str(0.5), '0.5 secs')
+        self.assertEqual(DelayTask.min_sec_str(15), '15 secs')
+        self.assertEqual(DelayTask.min_sec_str(75), '1:15 mins')
+
+    @patch.dict(HealthGatedDelayTask.checks, {'green': lambda state: True})
+    def test_health_gate_ends_delay(self):
+        state = {'seconds': 15, 'reversible': False, 'check': 'green',
+                'check_interval': 0.05, 'passes_needed': 2}
+        HealthGatedDelayTask._run(state, [], NotifyingEvent(), NotifyingEvent())
+        self.assertLess(state['run_waited'], 1)
+
+class TestSubprocessRun(KettleTestCase):
+    def test_output(self):
+        outputs = subprocess_run(['printf', ' a\\nb\\nc'], None, None)
+        self.assertEqual(outputs, ['a', 'b', 'c'])
+
+    def test_max_lines(self):
+        outputs = subprocess_run(['seq', '1000'], None, None, max_lines=2)
+        self.assertEqual(outputs, ['999', '1000'])
+
+    def test_term_while_silent(self):
+        abort, term = NotifyingEvent(), NotifyingEvent()
+        Timer(0.1, term.set).start()
+        start = time.time()
+        subprocess_run(['sleep', '30'], abort, term)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(abort.is_set())
+
+    def test_timeout_escalates_to_kill(self):
+        abort = NotifyingEvent()
+        start = time.time()
+        subprocess_run(['sh', '-c', 'trap "" TERM; echo ready; sleep 30'],
+                abort, None, timeout=0.2, kill_timeout=0.5, close_fds=True)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(abort.is_set())
+
+    def test_run_many_concurrently(self):
+        abort, term = NotifyingEvent(), NotifyingEvent()
+        start = time.time()
+        outputs = subprocess_run_many(
+                [['sh', '-c', 'sleep 0.5; echo %d' % i] for i in range(5)],
+                abort, term)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(outputs, [[str(i)] for i in range(5)])
+
+    def test_run_many_stops_starting_on_abort(self):
+        abort, term = NotifyingEvent(), NotifyingEvent()
+        outputs = subprocess_run_many(
+                [['true'], ['false'], ['echo', 'not run']], abort, term,
+                max_parallel=1)
+        self.assertEqual(outputs, [[], None, None])
+        self.assertTrue(abort.is_set())
+
+    def test_run_many_kills_started_on_error(self):
+        abort, term = NotifyingEvent(), NotifyingEvent()
+        with patch('kettle.tasks._Command.kill', autospec=True,
+                side_effect=tasks._Command.kill) as kill:
+            self.assertRaises(OSError, subprocess_run_many,
+                    [['sleep', '30'], ['/no/such/command']], abort, term)
+        self.assertEqual(kill.call_count, 1)
+        command = kill.call_args[0][0]
+        self.assertIsNotNone(command.p.returncode)
+        self.assertTrue(command.p.stdout.closed)
+
+    def test_parallel_command_task(self):
+        rollout = Rollout({})
+        rollout.save()
+        task = ParallelCommandTask(rollout.id, [['true'], ['false']], max_parallel=2)
+        task.save()
+        rollout._setup_signals_rollout()
+        try:
+            self.assertRaises(Exception, task.run)
+        finally:
+            rollout._teardown_signals_rollout()
+        self.assertIn('1 of 2 commands failed', task.run_error)
+
+    def test_parallel_command_task_without_signals(self):
+        rollout = Rollout({})
+        rollout.save()
+        task = ParallelCommandTask(rollout.id, [['false'], ['true']])
+        task.save()
+        self.assertRaises(Exception, task.run)
+        self.assertIn('1 of 2 commands failed', task.run_error)
+
 class TestSignals(KettleTestCase):
     def test_signals(self):
         rollouts = defaultdict(dict)
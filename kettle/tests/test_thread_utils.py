@@ -0,0 +1,69 @@
+from threading import Event, Thread
+from unittest import TestCase
+import time
+
+from mock import patch
+
+from kettle import thread_utils
+from kettle.thread_utils import (ExcRecordingThread, NotifyingEvent, WorkerPool,
+        thread_wait, wait_any)
+
+class TestWaitAny(TestCase):
+    def test_wakes_on_notifying_event(self):
+        event = NotifyingEvent()
+        Thread(target=lambda: (time.sleep(0.05), event.set())).start()
+        start = time.time()
+        self.assertTrue(wait_any((NotifyingEvent(), event, None)))
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_polls_plain_event(self):
+        event = Event()
+        Thread(target=lambda: (time.sleep(0.05), event.set())).start()
+        self.assertTrue(wait_any((NotifyingEvent(), event), timeout=1))
+
+    def test_timeout(self):
+        self.assertFalse(wait_any((NotifyingEvent(),), timeout=0.05))
+
+    def test_listener_removed(self):
+        event = NotifyingEvent()
+        wait_any((event,), timeout=0.01)
+        self.assertFalse(event._listeners)
+
+
+class TestThreadWait(TestCase):
+    def test_returns_when_thread_done(self):
+        thread = ExcRecordingThread(target=time.sleep, args=(0.05,))
+        thread.start()
+        start = time.time()
+        self.assertTrue(thread_wait(thread, NotifyingEvent()))
+        self.assertLess(time.time() - start, 0.5)
+
+    @patch('kettle.settings.ABORT_GRACE_TIMEOUT', 0.05)
+    def test_abort_grace_timeout(self):
+        release = Event()
+        thread = ExcRecordingThread(target=release.wait)
+        thread.start()
+        abort = NotifyingEvent()
+        abort.set()
+        try:
+            self.assertFalse(thread_wait(thread, abort))
+        finally:
+            release.set()
+
+
+class TestWorkerPool(TestCase):
+    @patch('kettle.settings.PARALLEL_MAX_TOTAL_WORKERS', 1)
+    def test_pools_share_total_workers(self):
+        release = Event()
+        pools = [WorkerPool(3), WorkerPool(3)]
+        try:
+            for pool in pools:
+                for _ in range(3):
+                    pool.submit(release.wait)
+            # Each pool gets its first thread, and only one more is shared
+            self.assertEqual([len(pool._threads) for pool in pools], [2, 1])
+        finally:
+            release.set()
+            for pool in pools:
+                pool.shutdown()
+        self.assertEqual(thread_utils._extra_workers[0], 0)
@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+
+from mock import patch
+
+from kettle.db import session
+from kettle.rollout import Rollout
+from kettle.signals import check_worker_backend
+from kettle.tests import KettleTestCase, create_task
+from kettle.worker import Worker, run_worker
+
+class TestWorker(KettleTestCase):
+    def make_queued_rollout(self):
+        rollout = Rollout({})
+        rollout.save()
+        create_task(rollout)
+        rollout.enqueue()
+        return rollout.id
+
+    def test_runs_queued_rollout(self):
+        rollout_id = self.make_queued_rollout()
+        worker = Worker(Rollout, 'test-worker', max_rollouts=1)
+        worker.step()
+        self.assertEqual(list(worker.running), [rollout_id])
+        worker.running[rollout_id].join(5)
+        worker.step()
+        self.assertFalse(worker.running)
+
+        rollout = Rollout._from_id(rollout_id)
+        self.assertEqual(rollout.status(), 'finished')
+        self.assertEqual(rollout.worker_id, 'test-worker')
+        self.assertIsNone(rollout.lease_expires_dt)
+
+    def test_unqueues_rollout_that_fails_to_start(self):
+        rollout = Rollout({})
+        rollout.save()
+        rollout.enqueue()
+        rollout_id = rollout.id
+        worker = Worker(Rollout, 'test-worker', max_rollouts=1)
+        worker.step()
+        worker.running[rollout_id].join(5)
+        worker.reap()
+
+        rollout = Rollout._from_id(rollout_id)
+        session.Session.refresh(rollout)
+        self.assertIsNone(rollout.queued_dt)
+        self.assertIsNone(rollout.worker_id)
+        self.assertEqual(rollout.status(), 'not_started')
+        rollout.enqueue()
+
+    def test_claim_once(self):
+        rollout_id = self.make_queued_rollout()
+        self.assertEqual(Rollout.claim_next('worker-1', 30), rollout_id)
+        self.assertIsNone(Rollout.claim_next('worker-2', 30))
+
+    def test_lost_worker(self):
+        rollout_id = self.make_queued_rollout()
+        Rollout.claim_next('worker-1', 30)
+        self.assertFalse(Rollout.lost_worker_query().all())
+
+        rollout = Rollout._from_id(rollout_id)
+        rollout.rollout_start_dt = datetime.now()
+        rollout.lease_expires_dt = datetime.now() - timedelta(seconds=1)
+        rollout.save()
+        self.assertEqual([r.id for r in Rollout.lost_worker_query()], [rollout_id])
+
+    def test_requeues_lost_unstarted_claim(self):
+        rollout_id = self.make_queued_rollout()
+        Rollout.claim_next('worker-1', 30)
+        rollout = Rollout._from_id(rollout_id)
+        rollout.lease_expires_dt = datetime.now() - timedelta(seconds=1)
+        rollout.save()
+        self.assertFalse(Rollout.lost_worker_query().all())
+
+        worker = Worker(Rollout, 'worker-2', max_rollouts=1)
+        worker.step()
+        self.assertEqual(list(worker.running), [rollout_id])
+        worker.running[rollout_id].join(5)
+        worker.reap()
+        rollout = Rollout._from_id(rollout_id)
+        session.Session.refresh(rollout)
+        self.assertEqual(rollout.status(), 'finished')
+        self.assertEqual(rollout.worker_id, 'worker-2')
+
+    @patch('kettle.settings.RESUME_POLICY', 'resume')
+    def test_resumes_lost_rollout(self):
+        rollout_id = self.make_queued_rollout()
+        Rollout.claim_next('worker-1', 30)
+        rollout = Rollout._from_id(rollout_id)
+        rollout.rollout_start_dt = datetime.now()
+        rollout.lease_expires_dt = datetime.now() - timedelta(seconds=1)
+        rollout.save()
+
+        worker = Worker(Rollout, 'worker-2', max_rollouts=1)
+        worker.check_lost()
+        self.assertEqual(list(worker.running), [rollout_id])
+        worker.running[rollout_id].join(5)
+        worker.reap()
+
+        rollout = Rollout._from_id(rollout_id)
+        session.Session.refresh(rollout)
+        self.assertEqual(rollout.status(), 'finished')
+        self.assertEqual(rollout.worker_id, 'worker-2')
+
+    @patch('kettle.settings.SIGNAL_BACKEND', 'kettle.signals:LocalSignalBackend')
+    def test_needs_db_signal_backend(self):
+        with patch.object(Worker, 'run') as run:
+            self.assertRaises(Exception, run_worker)
+            self.assertFalse(run.called)
+        with patch('kettle.settings.SIGNAL_BACKEND', 'kettle.signals:DBSignalBackend'):
+            check_worker_backend()
@@ -1,30 +1,203 @@
-from threading import Thread
+from Queue import Queue
+from threading import Event, Lock, Thread
 import sys
 import traceback
 
 import logbook
 
+import settings
 from log_utils import get_thread_handlers, inner_thread_nested_setup
+from utils import monotonic
+
+# How often wait_any checks events that can't notify it when they are set
+POLL_INTERVAL = 0.1
+
+# Threads started by all WorkerPools beyond their first, which is every task
+# thread that can be holding a DB connection at once
+_extra_workers = [0]
+_extra_workers_lock = Lock()
+
+class NotifyingEvent(object):
+    "Event that also sets any listener events registered on it when set"
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._listeners = set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    isSet = is_set
+
+    def set(self):
+        with self._lock:
+            self._event.set()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener.set()
+
+    def clear(self):
+        self._event.clear()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.add(listener)
+            if self._event.is_set():
+                listener.set()
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners.discard(listener)
+
+
+def wait_any(events, timeout=None):
+    """Block until any of events is set, or timeout seconds pass
+
+    None entries are ignored. Returns True if an event was set. Plain
+    Events are polled every POLL_INTERVAL; NotifyingEvents wake the waiter
+    as soon as they are set."""
+    events = [e for e in events if e is not None]
+    woken = Event()
+    polled = [e for e in events if not hasattr(e, 'add_listener')]
+    for event in events:
+        if event not in polled:
+            event.add_listener(woken)
+    try:
+        deadline = None if timeout is None else monotonic() + timeout
+        while not any(e.is_set() for e in events):
+            wait_secs = POLL_INTERVAL if polled else None
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                wait_secs = remaining if wait_secs is None else min(wait_secs, remaining)
+            woken.wait(wait_secs)
+        return True
+    finally:
+        for event in events:
+            if event not in polled:
+                event.remove_listener(woken)
+
 
 class ExcRecordingThread(Thread):
     "Thread that catches exceptions and stores them to its exc_info attribute"
     def __init__(self, *args, **kwargs):
         super(ExcRecordingThread, self).__init__(*args, **kwargs)
         self.exc_info = None
+        self.done = NotifyingEvent()
 
     def run(self):
         try:
             super(ExcRecordingThread, self).run()
         except Exception:
             self.exc_info = sys.exc_info()
+        finally:
+            self.done.set()
+
+
+class WorkItem(object):
+    "A callable queued on a WorkerPool. Quacks like an ExcRecordingThread"
+    def __init__(self, fn, name=None):
+        self.fn = fn
+        self.name = name
+        self.exc_info = None
+        self.done = NotifyingEvent()
+
+    def run(self):
+        try:
+            self.fn()
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.done.set()
+
+    def is_alive(self):
+        return not self.done.is_set()
+
+    def join(self, timeout=None):
+        self.done.wait(timeout)
+
+
+class WorkerPool(object):
+    """Runs queued callables on at most max_workers threads
+
+    Threads are started on demand as work is submitted, and each one works
+    through the queue until shutdown is called. Each thread keeps a single
+    database session for its lifetime rather than one per task.
+
+    Pools share PARALLEL_MAX_TOTAL_WORKERS threads beyond their first between
+    them. The first is always started, so a pool nested in a task of another
+    can't wait for ever on the outer pool's threads."""
+    def __init__(self, max_workers, name='worker'):
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = Queue()
+        self._threads = []
+        self._lock = Lock()
+
+    def submit(self, fn, name=None):
+        item = WorkItem(fn, name)
+        self._queue.put(item)
+        with self._lock:
+            if len(self._threads) < self.max_workers:
+                extra = bool(self._threads)
+                if not extra or self._reserve_extra():
+                    thread = Thread(target=self._work, args=(extra,),
+                            name='%s-%s' % (self.name, len(self._threads)))
+                    thread.daemon = True
+                    self._threads.append(thread)
+                    thread.start()
+        return item
+
+    @staticmethod
+    def _reserve_extra():
+        with _extra_workers_lock:
+            if _extra_workers[0] >= settings.PARALLEL_MAX_TOTAL_WORKERS:
+                return False
+            _extra_workers[0] += 1
+            return True
+
+    @staticmethod
+    def _release_extra():
+        with _extra_workers_lock:
+            _extra_workers[0] -= 1
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _work(self, extra):
+        from kettle.db import session
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                item.run()
+        finally:
+            session.Session.remove()
+            if extra:
+                self._release_extra()
 
 
 def make_exec_threaded(method_name):
-    def _exec_threaded(instance, abort):
+    def _exec_threaded(instance, abort, pool=None, term=None, abort_on_error=True):
         outer_handlers = get_thread_handlers()
         task_id = instance.id
+        name = instance.__class__.__name__
         def thread_wrapped_task():
             with inner_thread_nested_setup(outer_handlers):
+                # Children queued on a pool may only start after a signal
+                if pool is not None and (abort.is_set() or (term and term.is_set())):
+                    return
                 try:
                     # Reload from db
                     from kettle.tasks import Task
@@ -34,21 +207,28 @@ def make_exec_threaded(method_name):
                     # TODO: Fix logging
                     print traceback.format_exc()
                     logbook.exception()
-                    abort.set()
-        thread = ExcRecordingThread(target=thread_wrapped_task, name=instance.__class__.__name__)
+                    if abort_on_error:
+                        abort.set()
+                    # Recorded on the thread's exc_info for the parent task
+                    raise
+        if pool is not None:
+            return pool.submit(thread_wrapped_task, name=name)
+        thread = ExcRecordingThread(target=thread_wrapped_task, name=name)
         thread.start()
         return thread
     return _exec_threaded
 
-def thread_wait(thread, abort):
+def thread_wait(thread, abort, term=None):
+    """Block until thread finishes or, once abort or term is set, for at most
+    ABORT_GRACE_TIMEOUT seconds more. Returns whether the thread finished."""
     try:
-        while True:
-            if abort.is_set():
-                pass # TODO: Set some kinda timeout
-            if thread.is_alive():
-                thread.join(1)
-            else:
-                break
+        wait_any((thread.done, abort, term))
+        if thread.done.is_set():
+            return True
+        if not thread.done.wait(settings.ABORT_GRACE_TIMEOUT):
+            logbook.warning('Gave up waiting for %s after %s second grace period' %
+                    (thread.name, settings.ABORT_GRACE_TIMEOUT))
+        return thread.done.is_set()
     except Exception:
         # TODO: Fix logging
         print traceback.format_exc()
@@ -1,5 +1,11 @@
 from pprint import pformat
 
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2
+    from monotonic import monotonic
+
 def print_indented(format_object, indent=4):
     indent_str = ' ' * indent
     for line in (pformat(format_object, width=79-indent)).split('\n'):
@@ -0,0 +1,103 @@
+import os
+import socket
+from threading import Thread
+from time import sleep
+
+import logbook
+
+from kettle import settings
+from kettle.db import make_session, session
+from kettle.process_utils import get_pool
+from kettle.signals import check_worker_backend
+
+class Worker(object):
+    """Runs queued rollouts, several at a time, outside the web process
+
+    Each claimed rollout runs in its own thread with the usual Rollout._rollout
+    machinery. The main loop renews the leases on running rollouts, claims
+    more while under max_rollouts and resumes (or, with no RESUME_POLICY,
+    reports) rollouts whose worker died."""
+    def __init__(self, rollout_cls, worker_id=None, max_rollouts=None):
+        self.rollout_cls = rollout_cls
+        if worker_id is None:
+            worker_id = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.worker_id = worker_id
+        if max_rollouts is None:
+            max_rollouts = settings.WORKER_MAX_ROLLOUTS
+        self.max_rollouts = max_rollouts
+        self.running = {}
+        self.reported_lost = set()
+
+    def run(self):
+        logbook.info('Worker %s started' % (self.worker_id,))
+        while True:
+            self.step()
+            sleep(settings.WORKER_POLL_INTERVAL)
+
+    def step(self):
+        try:
+            self.reap()
+            self.rollout_cls.renew_leases(
+                    self.worker_id, list(self.running), settings.WORKER_LEASE_SECS)
+            self.check_lost()
+            self.rollout_cls.requeue_lost_claims()
+            while len(self.running) < self.max_rollouts:
+                rollout_id = self.rollout_cls.claim_next(
+                        self.worker_id, settings.WORKER_LEASE_SECS)
+                if rollout_id is None:
+                    break
+                self.start(rollout_id)
+        except Exception:
+            logbook.exception('Worker %s failed to poll' % (self.worker_id,))
+            session.Session.rollback()
+
+    def start(self, rollout_id, resume=False):
+        logbook.info('%s rollout %s' % ('Resuming' if resume else 'Starting', rollout_id))
+        thread = Thread(target=self._run_rollout, args=(rollout_id, resume),
+                name='rollout %s' % (rollout_id,))
+        thread.daemon = True
+        self.running[rollout_id] = thread
+        thread.start()
+
+    def _run_rollout(self, rollout_id, resume=False):
+        try:
+            if resume:
+                self.rollout_cls._resume(rollout_id)
+            else:
+                self.rollout_cls._rollout(rollout_id)
+        except Exception:
+            logbook.exception('Rollout %s failed' % (rollout_id,))
+            session.Session.rollback()
+            # If it failed before starting, e.g. with no tasks
+            self.rollout_cls.unqueue_unstarted(self.worker_id, rollout_id)
+        finally:
+            session.Session.remove()
+
+    def reap(self):
+        for rollout_id, thread in self.running.items():
+            if not thread.is_alive():
+                del self.running[rollout_id]
+                self.rollout_cls.release_lease(self.worker_id, rollout_id)
+                logbook.info('Finished rollout %s' % (rollout_id,))
+
+    def check_lost(self):
+        if settings.RESUME_POLICY:
+            for rollout_id in self.rollout_cls.claim_lost(
+                    self.worker_id, settings.WORKER_LEASE_SECS):
+                self.start(rollout_id, resume=True)
+            return
+        for rollout in self.rollout_cls.lost_worker_query():
+            if rollout.id in self.reported_lost:
+                continue
+            self.reported_lost.add(rollout.id)
+            logbook.error('Rollout %s lost its worker %s: lease expired at %s' % (
+                rollout.id, rollout.worker_id, rollout.lease_expires_dt))
+        session.Session.commit()
+
+
+def run_worker():
+    check_worker_backend()
+    if settings.PROCESS_POOL_EAGER:
+        get_pool()
+    make_session()
+    Worker(settings.get_cls(settings.ROLLOUT_CLS)).run()
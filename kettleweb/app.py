@@ -1,18 +1,28 @@
+import json
+import sqlite3
 import traceback
 from collections import OrderedDict
 from datetime import datetime, timedelta
-from os import path
+import os
 
-from flask import flash, Flask, request, render_template, redirect, Response, url_for
+from flask import (
+        abort, flash, Flask, jsonify, request, render_template, redirect,
+        Response, url_for)
 
 from logbook import FileHandler
 from logbook.compat import redirect_logging
 redirect_logging()
 
-from kettle import settings
+from kettle import events, settings
 from kettle.db import session, make_session
-from kettle.log_utils import log_filename
-from kettle.rollout import ALL_SIGNALS, SIGNAL_DESCRIPTIONS
+from kettle.log_search import (
+        get_index as get_log_index, indexer as log_indexer, search as search_logs)
+from kettle.log_utils import (
+        follow_file, iter_file, log_filename, multiplexer, open_log, tail_offset)
+from kettle.process_utils import get_pool
+from kettle.rollout import ALL_SIGNALS, DB_STATUSES, SIGNAL_DESCRIPTIONS
+from kettle.signals import check_worker_backend
+from kettle.summary import dashboard as rollout_dashboard
 
 from kettleweb.middleware import ReverseProxied, RemoteUserMiddleware
 
@@ -21,12 +31,28 @@ app = Flask(__name__)
 app.wsgi_app = ReverseProxied(RemoteUserMiddleware(app.wsgi_app))
 app.secret_key = settings.SECRET_KEY
 app.config['ROLLOUT_REFRESH_TIMEOUT'] = getattr(settings, 'ROLLOUT_REFRESH_TIMEOUT', 1000)
+# Events are only published in the process running the rollout
+app.config['ROLLOUT_EVENTS'] = not settings.USE_ROLLOUT_WORKER
+if settings.USE_ROLLOUT_WORKER:
+    check_worker_backend()
 app.config['CHECKLIST_URL'] = getattr(settings, 'CHECKLIST_URL', None)
 app.config['CHECKLIST_HEIGHT'] = getattr(settings, 'CHECKLIST_HEIGHT', None)
 app.config['CHECKLIST_CLICKTHROUGH_IMAGE_BASE64'] = getattr(settings, 'CHECKLIST_CLICKTHROUGH_IMAGE_BASE64', None)
 rollout_cls = settings.get_cls(settings.ROLLOUT_CLS)
 rollout_form_cls = settings.get_cls(settings.ROLLOUT_FORM_CLS)
 
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# Overlap between status polls, to catch writes stamped before a poll's
+# cursor but committed after it (and second-resolution DATETIMEs)
+CURSOR_SLACK = timedelta(seconds=2)
+# Seconds between comments sent to keep idle event streams open
+EVENT_KEEPALIVE = 15
+# Seconds between checks for new lines when following a log
+LOG_FOLLOW_INTERVAL = 0.5
+# Rollouts on each page of the rollout history
+ROLLOUT_PAGE_SIZE = 20
+DATE_FORMAT = '%Y-%m-%d'
+
 SIGNAL_LABELS = OrderedDict((sig, sig.replace('_', ' ').title()) for sig in ALL_SIGNALS)
 
 def available_signals(rollout_id):
@@ -84,7 +110,10 @@ def rollout_edit(rollout_id):
 def rollout_run(rollout_id):
     rollout = get_rollout(rollout_id)
     if rollout.generate_tasks_dt > datetime.now() - timedelta(minutes=5):
-        rollout.rollout_async()
+        if settings.USE_ROLLOUT_WORKER:
+            rollout.enqueue()
+        else:
+            rollout.rollout_async()
     else:
         flash('Cannot run - finalised more than 5 minutes ago. Refinalise!')
     return redirect(url_for('rollout_view', rollout_id=rollout_id))
@@ -112,21 +141,149 @@ def rollout_view(rollout_id):
         rollout = latest_rollout_query().first()
     else:
         rollout = get_rollout(rollout_id)
-    return render_template('rollout_view.html', rollout=rollout)
+    cursor = datetime.now().strftime(CURSOR_FORMAT)
+    return render_template('rollout_view.html', rollout=rollout, cursor=cursor)
+
+@app.route('/rollout/<int:rollout_id>/status.json')
+def rollout_status(rollout_id):
+    cursor = datetime.now()
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.strptime(since, CURSOR_FORMAT) - CURSOR_SLACK
+        except ValueError:
+            abort(400)
+    rollout = get_rollout(rollout_id)
+    return jsonify(
+            id=rollout.id,
+            status=rollout.status(),
+            status_html=rollout.friendly_status_html(),
+            rollout_friendly_status=rollout.rollout_friendly_status(),
+            rollback_friendly_status=rollout.rollback_friendly_status(),
+            signals=available_signals(rollout.id),
+            tasks=[t.status_dict() for t in rollout.tasks_changed_since(since or None)],
+            cursor=cursor.strftime(CURSOR_FORMAT))
+
+@app.route('/rollout/<int:rollout_id>/events')
+def rollout_events(rollout_id):
+    subscription = events.bus.subscribe(rollout_id)
+    def stream():
+        try:
+            yield 'retry: %d\n\n' % (app.config['ROLLOUT_REFRESH_TIMEOUT'],)
+            while not subscription.overflowed:
+                event = subscription.get(timeout=EVENT_KEEPALIVE)
+                if event is None:
+                    yield ': keepalive\n\n'
+                    continue
+                event_type, data = event
+                yield 'event: %s\ndata: %s\n\n' % (event_type, json.dumps(data))
+            # Fell too far behind: client should refetch the full status
+            yield 'event: resync\ndata: {}\n\n'
+        finally:
+            events.bus.unsubscribe(subscription)
+    return Response(stream(), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/rollout/')
 def rollout_index():
-    rollouts = latest_rollout_query()[:10]
-    return render_template('rollout_index.html', rollouts=rollouts)
+    filters = dict(
+            user=request.args.get('user', '').strip() or None,
+            statuses=[s for s in request.args.getlist('status') if s in DB_STATUSES] or None,
+            since=parse_date(request.args.get('since')),
+            until=parse_date(request.args.get('until')))
+    if filters['until'] is not None:
+        # Up to the end of the day
+        filters['until'] += timedelta(days=1)
+    before = request.args.get('before', type=int)
+    rows = rollout_cls.history_query(before=before, **filters)[:ROLLOUT_PAGE_SIZE + 1]
+    older = None
+    if len(rows) > ROLLOUT_PAGE_SIZE:
+        rows = rows[:ROLLOUT_PAGE_SIZE]
+        older = rows[-1][0].id
+    return render_template('rollout_index.html', rows=rows, before=before,
+            older=older, statuses=DB_STATUSES, args=request.args)
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
 
 @app.route('/log/<int:rollout_id>/<path:args>/')
 def log_view(rollout_id, args):
-    args = args.split('/')
-    log = log_filename(rollout_id, *args)
-    if path.exists(log):
-        return Response(open(log).read(), mimetype='text/plain')
-    else:
+    # Lines from rollouts running in this process may still be queued
+    multiplexer.flush()
+    try:
+        log = open_log(rollout_id, *args.split('/'))
+    except ValueError:
+        abort(404)
+    if log is None:
         return 'No such log file'
+    log_file, size = log
+    tail = request.args.get('tail', type=int)
+    follow = request.args.get('follow', type=int)
+    start = 0 if tail is None else tail_offset(log_file, tail)
+
+    if follow:
+        def is_live():
+            # Fresh session each time, to see the rollout's latest status
+            session.Session.remove()
+            try:
+                return get_rollout(rollout_id).status() not in (
+                        'not_started', 'finished', 'rollback_failed', 'rolled_back')
+            finally:
+                session.Session.remove()
+        body = follow_file(log_file, start, is_live, LOG_FOLLOW_INTERVAL)
+        return Response(closing_iter(body, log_file), mimetype='text/plain',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    status = 200
+    stop = size
+    if request.range is not None and tail is None:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            log_file.close()
+            return Response(status=416, headers={'Content-Range': 'bytes */%d' % (size,)})
+        start, stop = byte_range
+        status = 206
+    response = Response(
+            closing_iter(iter_file(log_file, start, stop - start), log_file),
+            status=status, mimetype='text/plain')
+    if status == 206:
+        response.headers['Content-Range'] = request.range.make_content_range(size).to_header()
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+@app.route('/search/')
+def log_search():
+    query = request.args.get('q', '').strip()
+    rollout_ids = request.args.getlist('rollout_id', type=int) or None
+    last = request.args.get('last', type=int)
+    results = None
+    if query and get_log_index() is None:
+        flash('Log search is disabled')
+    elif query:
+        multiplexer.flush()
+        log_indexer.flush()
+        try:
+            results = search_logs(query, rollout_ids, last)
+        except sqlite3.OperationalError, e:
+            flash('Bad search: %s' % (e,))
+    return render_template('search.html', query=query, rollout_ids=rollout_ids,
+            last=last, results=results)
+
+def closing_iter(body, f):
+    try:
+        for chunk in body:
+            yield chunk
+    finally:
+        f.close()
+
+@app.route('/dashboard/')
+def dashboard():
+    days = request.args.get('days', 30, type=int)
+    return render_template('dashboard.html', figures=rollout_dashboard(rollout_cls, days))
 
 @app.route('/')
 def index():
@@ -142,10 +299,17 @@ def get_rollout(rollout_id):
     return session.Session.query(rollout_cls).filter_by(id=rollout_id).one()
 
 def run_app():
+    if settings.PROCESS_POOL_EAGER:
+        get_pool()
     make_session()
     app.debug = settings.FLASK_DEBUG
+    # Not in the debug reloader's parent process, which serves no requests
+    if (settings.RESUME_POLICY and not settings.USE_ROLLOUT_WORKER and
+            (not app.debug or os.environ.get('WERKZEUG_RUN_MAIN'))):
+        rollout_cls.resume_orphaned_async()
     with FileHandler(log_filename('flask')):
-        app.run(host=settings.APP_HOST, port=settings.APP_PORT)
+        # Threaded so that event streams don't block other requests
+        app.run(host=settings.APP_HOST, port=settings.APP_PORT, threaded=True)
 
 
 if __name__ == '__main__':
@@ -20,6 +20,8 @@ setup(
     entry_points = """\
 [console_scripts]
 kettleweb=kettleweb.scripts:kettleweb
+kettle-worker=kettle.scripts:kettle_worker
+kettle-search=kettle.scripts:kettle_search
 """,
     install_requires=[
         'Logbook>=0.3',
@@ -27,6 +29,7 @@ kettleweb=kettleweb.scripts:kettleweb
         'Jinja2>=2.6',
         'WTForms>=0.6.3',
         'mock>=0.7.0',
+        'monotonic>=1.0',
         'SQLAlchemy>=0.7.5',
     ],
 )